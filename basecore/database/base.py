@@ -10,13 +10,17 @@ from operator import attrgetter
 import netrc
 import xnat
 from xnat.exceptions import XNATResponseError
+from requests.exceptions import RequestException
 from .exceptions import (
     XnatUtilsLookupError, XnatUtilsUsageError, XnatUtilsKeyError,
     XnatUtilsNoMatchingSessionsException,
     XnatUtilsSkippedAllSessionsException, XnatUtilsError)
+from .catalog import ProjectCatalog
+from .retry import default_policy, is_auth_error
+from .pool import session_pool, get_interface
+from .metadata_cache import get_metadata_cache
 import warnings
 import logging
-from pyxnat import Interface
 
 
 logger = logging.getLogger('xnat-utils')
@@ -55,6 +59,8 @@ session_modality_re = re.compile(r'\w+_\w+_(MR|CT|RT)(\d+|\w+)')
 
 server_name_re = re.compile(r'(http://|https://)?([\w\-\.]+).*')
 
+word_re = re.compile(r'^\w+$')
+
 
 def connect(server=None, user=None, loglevel='ERROR', connection=None,
             use_netrc=True, failures=0, password=None):
@@ -89,8 +95,11 @@ def connect(server=None, user=None, loglevel='ERROR', connection=None,
         are not also provided
     Returns
     -------
-    connection : xnat.Session
-        A XnatPy session
+    connection : WrappedXnatSession
+        A XnatPy session, wrapped so that it is not disconnected at the end
+        of a 'with' block. Sessions are kept in a process-wide pool (see
+        basecore.database.pool) and reused by the following calls for the
+        same server and user
     """
     if connection is not None:
         return WrappedXnatSession(connection)
@@ -141,6 +150,11 @@ def connect(server=None, user=None, loglevel='ERROR', connection=None,
     if server is None:
         server = input(
             'XNAT server domain name (e.g. mbi-xnat.erc.monash.edu.au): ')
+    # Reuse the session already opened by this process, if any
+    server_name = server_name_re.match(server).group(2)
+    pooled = session_pool.find('xnat', server_name, user)
+    if pooled is not None:
+        return WrappedXnatSession(pooled)
     if not netrc_match:
         if user is None:
             user = input("XNAT username for '{}': ".format(server))
@@ -200,18 +214,16 @@ def connect(server=None, user=None, loglevel='ERROR', connection=None,
                     "To prevent this from happening in the future pass "
                     "the '--no_netrc' or '-n' option".format(
                         server, netrc_path))
-    return connection
+    session_pool.add('xnat', server_name, user, connection)
+    return WrappedXnatSession(connection)
 
 
 def get_subject_list(project_id, url, user, pwd):
 
-    interface = Interface(server=url, user=user, password=pwd,
+    interface = get_interface(server=url, user=user, password=pwd,
                               proxy='www-int2:80')
 
-    xnat_subjects = interface.select.project(project_id).subjects().get()
-    xnat_sub_labels = [interface.select.project(project_id).subject(x).label()
-                       for x in xnat_subjects]
-    return xnat_sub_labels
+    return list(ProjectCatalog(interface, project_id).subjects.keys())
 
 
 def write_netrc(netrc_path, servers):
@@ -254,7 +266,26 @@ def is_regex(ids):
     "Checks to see if string contains special characters"
     if isinstance(ids, basestring):
         ids = [ids]
-    return not all(re.match(r'^\w+$', i) for i in ids)
+    return not all(word_re.match(i) for i in ids)
+
+
+def compile_patterns(patterns):
+    """
+    Compiles a list of regexes into a single alternation that matches a
+    whole label if any of the regexes does, so that each label is checked
+    with one match call instead of one per regex
+
+    Parameters
+    ----------
+    patterns : list(str)
+        The regexes to combine
+
+    Returns
+    -------
+    re.Pattern
+        The compiled alternation, to be used with its match method
+    """
+    return re.compile('|'.join('(?:{})$'.format(p) for p in patterns))
 
 
 def list_results(login, path, attr):
@@ -310,9 +341,9 @@ def matching_subjects(login, subject_ids):
     if isinstance(subject_ids, basestring):
         subject_ids = [subject_ids]
     if is_regex(subject_ids):
+        pattern = compile_patterns(subject_ids)
         subjects = [s for s in login.subjects.values()
-                    if any(re.match(i + '$', s.label)
-                           for i in subject_ids)]
+                    if pattern.match(s.label)]
     else:
         subjects = set()
         for id_ in subject_ids:
@@ -326,6 +357,71 @@ def matching_subjects(login, subject_ids):
     return sorted(subjects, key=attrgetter('label'))
 
 
+def session_index(login, project_id=None):
+    """
+    Lists the date and the scans of all the sessions of a project (or of all
+    the projects accessible), with a single request, so that sessions can be
+    filtered without loading each of them. The listing is kept in the
+    metadata cache (see basecore.database.metadata_cache)
+
+    Parameters
+    ----------
+    login : xnat.Session
+        The XNAT session object
+    project_id : str | None
+        The project to list the sessions of
+
+    Returns
+    -------
+    dict
+        session ID -> (date, list of scan types (or IDs for the scans
+        without type)). An empty dictionary is returned if the listing
+        fails (including connection errors)
+    """
+    if project_id is not None:
+        uri = '/data/projects/{}/experiments'.format(project_id)
+    else:
+        uri = '/data/experiments'
+    query = {'columns': ('ID,date,xnat:imageScanData/ID,'
+                         'xnat:imageScanData/type')}
+
+    def request():
+        return default_policy.call('list the sessions', login.get_json, uri,
+                                   query=query)['ResultSet']['Result']
+    cache = get_metadata_cache()
+    try:
+        if cache is not None:
+            rows = cache.fetch(login, uri, query, request)
+        else:
+            rows = request()
+    except (XNATResponseError, RequestException, OSError, ValueError,
+            KeyError) as e:
+        logger.warning("Could not list the sessions in {} ({}), they will be "
+                       "loaded one by one".format(uri, e))
+        return {}
+    index = {}
+    # sessions with a date that cannot be parsed are left out of the index,
+    # so they are loaded one by one
+    unparsed = set()
+    for row in rows:
+        row = dict((k.lower(), v) for k, v in row.items())
+        if row['id'] in unparsed:
+            continue
+        if row['id'] not in index:
+            try:
+                date = (datetime.strptime(row['date'], '%Y-%m-%d').date()
+                        if row.get('date') else None)
+            except ValueError:
+                unparsed.add(row['id'])
+                continue
+            index[row['id']] = (date, [])
+        scan_id = row.get('xnat:imagescandata/id')
+        if scan_id:
+            index[row['id']][1].append(
+                row.get('xnat:imagescandata/type') or scan_id)
+    return index
+
+
 def matching_sessions(login, session_ids, with_scans=None,
                       without_scans=None, skip=(), before=None,
                       after=None, project_id=None):
@@ -370,21 +466,41 @@ def matching_sessions(login, session_ids, with_scans=None,
         without_scans = [without_scans]
     elif without_scans is None:
         without_scans = ()
+    # Each of with_scans must match, any of without_scans is enough to
+    # exclude a session
+    with_patterns = [compile_patterns([i]) for i in with_scans]
+    without_pattern = compile_patterns(without_scans) if without_scans else None
+
+    # The bulk listing of the sessions is only worth it when whole projects
+    # (or the sessions matching a regex) are selected. Sessions and subjects
+    # given by name are loaded one by one, as the listing would include all
+    # the scans of the project (or of the server)
+    index = {}
+    indexed_projects = []
 
     def valid(session):
-        if before is not None and session.date > before:
+        # Sessions missing from the bulk listing are loaded lazily
+        if session.id in index:
+            date, scans = index[session.id]
+        else:
+            date = session.date if (before or after) else None
+            scans = None
+        if (before is not None or after is not None) and date is None:
+            return False
+        if before is not None and date > before:
             return False
-        if after is not None and session.date < after:
+        if after is not None and date < after:
             return False
         if with_scans or without_scans:
-            scans = [(s.type if s.type is not None else s.id)
-                     for s in session.scans.values()]
-            for scan_type in with_scans:
-                if not any(re.match(scan_type + '$', s) for s in scans):
-                    return False
-            for scan_type in without_scans:
-                if any(re.match(scan_type + '$', s) for s in scans):
+            if scans is None:
+                scans = [(s.type if s.type is not None else s.id)
+                         for s in session.scans.values()]
+            for pattern in with_patterns:
+                if not any(pattern.match(s) for s in scans):
                     return False
+            if without_pattern is not None and any(
+                    without_pattern.match(s) for s in scans):
+                return False
         return True
 
     if project_id is not None:
@@ -397,9 +513,10 @@ def matching_sessions(login, session_ids, with_scans=None,
     else:
         base = login
     if is_regex(session_ids):
+        pattern = compile_patterns(session_ids)
         sessions = [s for s in base.experiments.values()
-                    if any(re.match(i + '$', s.label)
-                           for i in session_ids)]
+                    if pattern.match(s.label)]
+        indexed_projects.append(project_id)
     else:
         sessions = set()
         for id_ in session_ids:
@@ -421,6 +538,7 @@ def matching_sessions(login, session_ids, with_scans=None,
                             "No project named '{}'".format(id_))
                     project_id = id_
                 sessions.update(project.experiments.values())
+                indexed_projects.append(id_)
             elif id_ .count('_') == 1:
                 try:
                     subject = base.subjects[id_]
@@ -438,6 +556,9 @@ def matching_sessions(login, session_ids, with_scans=None,
             else:
                 raise XnatUtilsKeyError(
                     id_, "Invalid ID '{}' for listing sessions".format(id_))
+    if before is not None or after is not None or with_scans or without_scans:
+        for indexed_project in indexed_projects:
+            index.update(session_index(login, indexed_project))
     filtered = [s for s in sessions if valid(s)]
     if not filtered:
         raise XnatUtilsNoMatchingSessionsException(
@@ -466,8 +587,8 @@ def matching_scans(session, scan_types, match_id=True):
         return label
     matches = session.scans.values()
     if scan_types is not None:
-        matches = (s for s in matches if any(
-            re.match(i + '$', label(s)) for i in scan_types))
+        pattern = compile_patterns(scan_types)
+        matches = (s for s in matches if pattern.match(label(s)))
     return sorted(matches, key=label)
 
 
@@ -505,8 +626,14 @@ class WrappedXnatSession(object):
     def __enter__(self):
         return self._session
 
-    def __exit__(self, *args, **kwargs):
-        pass
+    def __exit__(self, exc_type, exc_value, traceback):
+        # a session whose login expired is not reused by the next calls. The
+        # error may have been wrapped in a XnatUtils exception (e.g. by put)
+        while exc_value is not None:
+            if is_auth_error(exc_value):
+                session_pool.discard(self._session)
+                break
+            exc_value = exc_value.__context__
 
 
 def remove_ignore_errors(path):
@@ -0,0 +1,167 @@
+import re
+from collections import OrderedDict
+from requests.exceptions import HTTPError
+from .exceptions import XnatUtilsError
+from .retry import default_policy
+from .pool import check_response
+from .metadata_cache import get_metadata_cache
+
+
+file_uri_re = re.compile(r'.*/scans/(?P<scan>[^/]+)/resources/(?P<resource>[^/]+)/files/')
+
+
+def list_json(interface, uri, policy=default_policy, use_cache=True, **params):
+    """
+    Runs a listing request on the XNAT REST API through a pyxnat Interface
+    and returns the list of results (one dictionary per object). Listings are
+    served from the metadata cache (see basecore.database.metadata_cache)
+    when possible
+
+    Parameters
+    ----------
+    interface : pyxnat.Interface
+        Interface connected to the XNAT server
+    uri : str
+        REST path of the listing (e.g. /data/projects/TEST/subjects)
+    policy : basecore.database.retry.RetryPolicy
+        Policy used to repeat the request after transient errors
+    use_cache : bool
+        Whether the listing can be taken from, and stored in, the cache
+    params : dict
+        Additional query parameters (e.g. columns)
+
+    Returns
+    -------
+    list(dict)
+        The rows of the ResultSet returned by XNAT
+    """
+    params['format'] = 'json'
+
+    def request():
+        response = interface.get(uri, params=params)
+        check_response(interface, response)
+        return response.json()['ResultSet']['Result']
+    cache = get_metadata_cache() if use_cache else None
+    try:
+        if cache is not None:
+            return cache.fetch(interface, uri, params,
+                               lambda: policy.call('list ' + uri, request))
+        return policy.call('list ' + uri, request)
+    except HTTPError as e:
+        raise XnatUtilsError("Could not list {} ({})".format(uri, e))
+
+
+def list_experiment_files(interface, experiment_id, policy=default_policy):
+    """
+    Lists all the files of all the scans of an experiment with a single
+    request
+
+    Parameters
+    ----------
+    interface : pyxnat.Interface
+        Interface connected to the XNAT server
+    experiment_id : str
+        XNAT ID of the experiment
+    policy : basecore.database.retry.RetryPolicy
+        Policy used to repeat the request after transient errors
+
+    Returns
+    -------
+    OrderedDict
+        scan ID -> OrderedDict resource label -> list of file rows
+        (Name, Size, URI, digest)
+    """
+    rows = list_json(interface, '/data/experiments/{}/scans/ALL/files'
+                     .format(experiment_id), policy=policy)
+    scans = OrderedDict()
+    for row in rows:
+        match = file_uri_re.match(row['URI'])
+        if match is None:
+            continue
+        resource = row.get('collection') or match.group('resource')
+        scans.setdefault(match.group('scan'), OrderedDict()).setdefault(
+            resource, []).append(row)
+    return scans
+
+
+class ProjectCatalog(object):
+    """In-memory tree of the subjects, experiments, scans, resources and files
+    of one XNAT project, built with a few bulk listing requests instead of
+    walking the project object by object:
+
+    - one request for the subjects of the project
+    - one request for the experiments of the project
+    - one request per experiment for all the files in all its scans, when
+      the files are needed
+
+    Subjects and experiments are keyed by label, scans by ID and resources
+    by label.
+
+    Parameters
+    ----------
+    interface : pyxnat.Interface
+        Interface connected to the XNAT server
+    project_id : str
+        ID of the project
+    """
+
+    def __init__(self, interface, project_id):
+        self.interface = interface
+        self.project_id = project_id
+        self._subjects = None
+        self._experiments = None
+
+    @property
+    def subjects(self):
+        "OrderedDict subject label -> subject row (ID, label, URI)"
+        if self._subjects is None:
+            rows = list_json(
+                self.interface, '/data/projects/{}/subjects'.format(self.project_id),
+                columns='ID,label,URI')
+            self._subjects = OrderedDict((r['label'], r) for r in rows)
+        return self._subjects
+
+    def subject_label(self, subject):
+        "Returns the label of a subject given its label or its XNAT ID"
+        if subject in self.subjects:
+            return subject
+        for label, row in self.subjects.items():
+            if row['ID'] == subject:
+                return label
+        return None
+
+    @property
+    def experiments(self):
+        """OrderedDict subject label -> OrderedDict experiment label ->
+        experiment row (ID, label, subject_ID, date, xsiType, URI)"""
+        if self._experiments is None:
+            rows = list_json(
+                self.interface, '/data/projects/{}/experiments'.format(self.project_id),
+                columns='ID,label,subject_ID,date,xsiType,URI')
+            labels = dict((r['ID'], l) for l, r in self.subjects.items())
+            self._experiments = OrderedDict((l, OrderedDict()) for l in self.subjects)
+            for row in rows:
+                sub_label = labels.get(row['subject_ID'])
+                if sub_label is not None:
+                    self._experiments[sub_label][row['label']] = row
+        return self._experiments
+
+    def files(self, experiment):
+        """
+        Lists all the files of all the scans of an experiment with a single
+        request (see list_experiment_files)
+
+        Parameters
+        ----------
+        experiment : dict
+            Experiment row, as stored in ProjectCatalog.experiments
+
+        Returns
+        -------
+        OrderedDict
+            scan ID -> OrderedDict resource label -> list of file rows
+            (Name, Size, URI, digest)
+        """
+        if 'scans' not in experiment:
+            experiment['scans'] = list_experiment_files(self.interface, experiment['ID'])
+        return experiment['scans']
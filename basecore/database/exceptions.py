@@ -14,6 +14,10 @@ class XnatUtilsDigestCheckFailedError(XnatUtilsDigestCheckError):
     pass
 
 
+class XnatUtilsUploadError(XnatUtilsError):
+    pass
+
+
 class XnatUtilsNoMatchingSessionsException(XnatUtilsException):
     pass
 
@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+from basecore.utils.sqlite_db import SQLiteDatabase
+
+
+# Seconds a listing stays valid. It can be changed with the
+# BASECORE_XNAT_CACHE_TTL environment variable; 0 disables the cache.
+DEFAULT_TTL = 300
+# Path of the on-disk copy of the cache, shared by the processes using the
+# same path. It is set with the BASECORE_XNAT_CACHE environment variable; by
+# default the listings are only cached in memory.
+DEFAULT_PATH = ''
+# Maximum number of listings kept in memory
+MAX_LISTINGS = 10000
+
+project_uri_re = re.compile(r'/data/(?:archive/)?projects/([^/?]+)')
+
+
+def project_of(uri):
+    "Returns the ID of the project an URI belongs to, or None"
+    match = project_uri_re.match(uri)
+    return match.group(1) if match is not None else None
+
+
+def _server_of(session):
+    "Server URL and user of a pyxnat Interface or of a XnatPy session"
+    server = (getattr(session, '_original_uri', None)
+              or getattr(session, '_server', None))
+    user = (getattr(session, '_user', None)
+            or getattr(session, '_logged_in_user', None))
+    # XnatPy strips the trailing '/' of the server URL, pyxnat does not
+    return str(server).rstrip('/'), str(user)
+
+
+class MetadataCache(object):
+    """Cache of the listings (subjects, experiments, scans, files) returned by
+    the XNAT REST API, shared by basecore.database.base, xnat and pyxnat, so
+    that a batch job does not request the same listings over and over.
+
+    Listings are keyed by server, user, URI and query parameters and expire
+    after ttl seconds. Every write to a project (see invalidate) drops the
+    listings of that project, and the ones that cannot be attributed to a
+    project, for all the users of the server.
+
+    Parameters
+    ----------
+    ttl : float
+        Seconds a listing stays valid
+    path : str | None
+        path to a SQLite database where the listings are also stored, so that
+        they are shared with other processes. It will be created if it does
+        not exist
+    max_listings : int
+        Maximum number of listings kept in memory. Expired listings are
+        dropped first, then the oldest ones
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, path=None, max_listings=MAX_LISTINGS):
+        self.ttl = ttl
+        self.path = path
+        self.max_listings = max_listings
+        self._listings = {}
+        if path:
+            self._db = SQLiteDatabase(path, ['CREATE TABLE IF NOT EXISTS listings (key TEXT '
+                                             'PRIMARY KEY, server TEXT, project TEXT, '
+                                             'stored REAL, rows TEXT)'])
+        self._lock = threading.Lock()
+
+    def _disable_disk(self, error):
+        print('The XNAT metadata cache {0} cannot be used ({1}). The listings '
+              'will only be cached in memory.'.format(self.path, error))
+        self.path = None
+
+    @staticmethod
+    def _key(session, uri, params):
+        server, user = _server_of(session)
+        return server, json.dumps([server, user, uri, sorted((params or {}).items())])
+
+    def get(self, session, uri, params=None):
+        """
+        Returns a copy of the cached listing of uri with the given query
+        parameters, or None if it is not cached or it expired
+        """
+        server, key = self._key(session, uri, params)
+        oldest = time.time() - self.ttl
+        with self._lock:
+            stored, _, rows = self._listings.get(key, (None, None, None))
+            if stored is not None and stored < oldest:
+                del self._listings[key]
+            if (stored is None or stored < oldest) and self.path:
+                try:
+                    row = self._db.connect().execute(
+                        'SELECT stored, project, rows FROM listings WHERE key=?',
+                        (key,)).fetchone()
+                except (sqlite3.Error, OSError) as e:
+                    self._disable_disk(e)
+                    row = None
+                if row is not None and row[0] >= oldest:
+                    stored, project, rows = row
+                    self._store(key, (stored, project, rows))
+        if stored is None or stored < oldest:
+            return None
+        # the callers are free to modify the listings they get
+        return json.loads(rows)
+
+    def set(self, session, uri, params, rows):
+        "Stores the listing of uri with the given query parameters"
+        server, key = self._key(session, uri, params)
+        entry = (time.time(), project_of(uri), json.dumps(rows))
+        with self._lock:
+            self._store(key, entry)
+            if self.path:
+                try:
+                    conn = self._db.connect()
+                    with conn:
+                        conn.execute('INSERT OR REPLACE INTO listings (key, server, stored, '
+                                     'project, rows) VALUES (?, ?, ?, ?, ?)',
+                                     (key, server) + entry)
+                except (sqlite3.Error, OSError) as e:
+                    self._disable_disk(e)
+
+    def _store(self, key, entry):
+        "Keeps a listing in memory, making room for it if needed (called with the lock held)"
+        self._listings.pop(key, None)
+        if len(self._listings) >= self.max_listings:
+            oldest = time.time() - self.ttl
+            for old_key, (stored, _, _) in list(self._listings.items()):
+                if stored < oldest:
+                    del self._listings[old_key]
+            # dictionaries keep the insertion order: the first listings are the
+            # ones stored first
+            while len(self._listings) >= self.max_listings:
+                del self._listings[next(iter(self._listings))]
+        self._listings[key] = entry
+
+    def fetch(self, session, uri, params, request):
+        """
+        Returns the cached listing of uri, calling request() to get it from
+        the server if it is not cached or it expired
+        """
+        rows = self.get(session, uri, params)
+        if rows is None:
+            rows = request()
+            self.set(session, uri, params, rows)
+        return rows
+
+    def invalidate(self, session, uri=None):
+        """
+        Drops the listings of the project uri belongs to, and the ones not
+        attributed to any project, after a write to uri. If uri is None, or
+        it is not inside a project, all the listings of the server are
+        dropped.
+        """
+        server, _ = _server_of(session)
+        project = project_of(uri) if uri is not None else None
+        with self._lock:
+            for key, (_, listed, _) in list(self._listings.items()):
+                if (json.loads(key)[0] == server
+                        and (project is None or listed is None or listed == project)):
+                    del self._listings[key]
+            if self.path:
+                try:
+                    conn = self._db.connect()
+                    with conn:
+                        if project is None:
+                            conn.execute('DELETE FROM listings WHERE server=?', (server,))
+                        else:
+                            conn.execute('DELETE FROM listings WHERE server=? AND '
+                                         '(project IS NULL OR project=?)',
+                                         (server, project))
+                except (sqlite3.Error, OSError) as e:
+                    self._disable_disk(e)
+
+    def clear(self):
+        "Drops all the cached listings"
+        with self._lock:
+            self._listings.clear()
+            if self.path:
+                try:
+                    conn = self._db.connect()
+                    with conn:
+                        conn.execute('DELETE FROM listings')
+                except (sqlite3.Error, OSError) as e:
+                    self._disable_disk(e)
+
+
+_caches = {}
+
+
+def get_metadata_cache():
+    """Returns the XNAT metadata cache of this process, or None if the cache
+    was disabled through the BASECORE_XNAT_CACHE_TTL environment variable.
+    """
+    ttl = float(os.environ.get('BASECORE_XNAT_CACHE_TTL', DEFAULT_TTL))
+    if ttl <= 0:
+        return None
+    path = os.environ.get('BASECORE_XNAT_CACHE', DEFAULT_PATH) or None
+    if (ttl, path) not in _caches:
+        _caches[(ttl, path)] = MetadataCache(ttl=ttl, path=path)
+    return _caches[(ttl, path)]
+
+
+def invalidate(session, uri=None):
+    "Drops the cached listings affected by a write to uri (see MetadataCache.invalidate)"
+    cache = get_metadata_cache()
+    if cache is not None:
+        cache.invalidate(session, uri)
@@ -0,0 +1,142 @@
+import atexit
+import threading
+from pyxnat import Interface
+from .retry import is_auth_error
+
+
+class SessionPool(object):
+    """Process-wide pool of the logged in connections to XNAT servers, so
+    that all the functions in basecore.database reuse the same session (and
+    its keep-alive HTTP connections and session token) instead of logging in
+    at every call. The sessions are kept open until the pool is closed, which
+    happens automatically when the process exits.
+
+    Sessions are keyed by kind ('xnat' for XnatPy sessions, 'pyxnat' for
+    pyxnat Interfaces), server and user. A session whose login is rejected
+    by the server is discarded, so that the next call logs in again.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        # keys of the sessions being opened -> Event set once they are open
+        self._opening = {}
+        self._lock = threading.RLock()
+
+    def find(self, kind, server, user=None):
+        """
+        Returns the session opened for the given server and user, or None.
+        If user is None, any session opened for the server is returned.
+        """
+        with self._lock:
+            if (kind, server, user) in self._sessions:
+                return self._sessions[(kind, server, user)]
+            if user is None:
+                for (k, s, _), session in self._sessions.items():
+                    if k == kind and s == server:
+                        return session
+        return None
+
+    def add(self, kind, server, user, session):
+        "Adds an open session to the pool"
+        with self._lock:
+            self._sessions[(kind, server, user)] = session
+
+    def get(self, kind, server, user, factory):
+        """
+        Returns the session for the given server and user, opening it with
+        factory() if it is not in the pool yet. The login runs outside the
+        lock, so that it does not hold up the callers using other sessions,
+        while the callers asking for the same session wait for it
+        """
+        key = (kind, server, user)
+        while True:
+            with self._lock:
+                session = self.find(kind, server, user)
+                if session is not None:
+                    return session
+                opening = self._opening.get(key)
+                if opening is None:
+                    opening = self._opening[key] = threading.Event()
+                    break
+            # if the login fails, the next caller in line tries again
+            opening.wait()
+        try:
+            session = factory()
+            self.add(kind, server, user, session)
+        finally:
+            with self._lock:
+                del self._opening[key]
+            opening.set()
+        return session
+
+    def discard(self, session):
+        "Removes a session from the pool (e.g. after its login expired)"
+        with self._lock:
+            for key, pooled in list(self._sessions.items()):
+                if pooled is session:
+                    del self._sessions[key]
+
+    def close(self):
+        "Disconnects all the sessions in the pool"
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            try:
+                session.disconnect()
+            except Exception:
+                # the server may already have closed the session
+                pass
+
+
+session_pool = SessionPool()
+atexit.register(session_pool.close)
+
+
+def check_response(session, response):
+    """
+    Raises the HTTP error of a response received through a pooled session
+    (see requests.Response.raise_for_status). If the server rejected the
+    login, the session is discarded from the pool first
+    """
+    try:
+        response.raise_for_status()
+    except Exception as e:
+        if is_auth_error(e):
+            session_pool.discard(session)
+        raise
+
+
+def get_interface(server=None, user=None, password=None, config=None,
+                  proxy=None):
+    """
+    Returns a pyxnat Interface for the given server and user (or
+    configuration file), reusing the one already opened by this process
+    if there is one
+
+    Parameters
+    ----------
+    server : str
+        URL of the XNAT server
+    user : str
+        The user to connect to the server with
+    password : str
+        Password of the user
+    config : str
+        Path to a pyxnat configuration file, used instead of server, user
+        and password
+    proxy : str
+        Proxy used to connect to the server
+
+    Returns
+    -------
+    pyxnat.Interface
+        The pooled interface
+    """
+    if config is not None:
+        return session_pool.get('pyxnat', config, None,
+                                lambda: Interface(config))
+    return session_pool.get(
+        'pyxnat', server, user,
+        lambda: Interface(server=server, user=user, password=password,
+                          proxy=proxy))
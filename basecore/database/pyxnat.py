@@ -1,187 +1,447 @@
-from pyxnat import Interface
-from pyxnat.core.errors import DatabaseError
 import re
 import os
 import glob
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .base import get_resource_name
+from .catalog import ProjectCatalog, list_json, list_experiment_files
+from .retry import default_policy, get_policy
+from .pool import get_interface, check_response
+from .metadata_cache import invalidate
+from .exceptions import XnatUtilsError, XnatUtilsDigestCheckError
+from .utils import iter_zip, md5_digest, download_file, DigestReader
 from basecore.utils.filemanip import split_filename
 
 
 session_modality_re = re.compile(r'(MR|CT|RT)(\d+|\w+)')
+# Name of the file, inside the download directory, that keeps track of the
+# files already downloaded
+DOWNLOAD_MANIFEST = '.download_manifest.jsonl'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
 
-def put(project, subject, sessions, sub_folder, config=None, url=None, pwd=None, user=None,
-        processed=False):
+def get_resource_digests(interface, resource_uri):
+    """
+    Lists the files in a resource with a single request and returns their
+    MD5 digests as a dictionary (file name -> digest)
+    """
+    try:
+        files = list_json(interface, resource_uri + '/files', use_cache=False)
+    except XnatUtilsError:
+        raise XnatUtilsError(
+            "Could not download metadata for resource {}. Files "
+            "may have been uploaded but cannot check checksums"
+            .format(resource_uri))
+    return dict((r['Name'], r['digest']) for r in files)
 
-    if config is not None:
-        interface = Interface(config)
-    else:
-        interface = Interface(server=url, user=user,password=pwd,
-                              proxy='www-int2:80')
-    
-    uri =  '/data/projects/%s/subjects/%s'%(project, subject)
-    response = interface.put(uri)
+
+def put_zip(interface, resource_uri, filenames, archive_name, policy=default_policy):
+    """
+    Uploads a list of files to a resource as a single zip archive, streamed
+    on the fly and extracted by XNAT, and then checks the digests of the
+    extracted files
+    """
+    local_digests = {}
+
+    def send():
+        local_digests.clear()
+        response = interface.put(
+            '{}/files/{}'.format(resource_uri, archive_name),
+            params={'extract': 'true', 'inbody': 'true', 'overwrite': 'true'},
+            headers={'Content-Type': 'application/zip'},
+            data=iter_zip(filenames, local_digests))
+        check_response(interface, response)
+    try:
+        policy.call('upload ' + archive_name, send)
+    finally:
+        invalidate(interface, resource_uri)
+    check_digests(interface, resource_uri, local_digests)
+
+
+def check_digests(interface, resource_uri, local_digests):
+    """
+    Checks the digests of files uploaded to a resource against the ones
+    computed locally (dictionary file name -> MD5 digest)
+    """
+    remote_digests = get_resource_digests(interface, resource_uri)
+    for fname, local_digest in local_digests.items():
+        remote_digest = remote_digests.get(
+            os.path.basename(fname).replace(' ', '%20'))
+        if local_digest != remote_digest:
+            raise XnatUtilsDigestCheckError(
+                "Remote digest does not match local ({} vs {}) "
+                "for {}. Please upload your datasets again"
+                .format(remote_digest, local_digest, fname))
+
+
+def _put(interface, description, uri, policy=default_policy, **kwargs):
+    "Runs a PUT request, repeating it after transient errors"
+    def send():
+        response = interface.put(uri, **kwargs)
+        check_response(interface, response)
+        return response
+    try:
+        return policy.call(description, send)
+    finally:
+        invalidate(interface, uri)
+
+
+def upload_file(interface, resource_uri, fname, res_format, policy=default_policy):
+    """
+    Uploads a file to a resource, streaming it in the body of the request,
+    and returns its MD5 digest, computed while the file is sent
+    """
+    def send():
+        with DigestReader(fname) as f:
+            response = interface.put(
+                '{}/files/{}'.format(resource_uri, os.path.basename(fname)),
+                params={'format': res_format, 'content': res_format,
+                        'inbody': 'true', 'overwrite': 'true'},
+                data=f)
+            check_response(interface, response)
+            return f.hexdigest()
+    try:
+        return policy.call('upload ' + os.path.basename(fname), send)
+    finally:
+        invalidate(interface, resource_uri)
+
+
+def _session_types(session, processed):
+    """
+    Returns the suffix of the experiment label and the XNAT types of the
+    experiment and of its scans for a session folder
+    """
+    match = session_modality_re.match(session)
+    if match is None and processed:
+        return '_processed', 'xnat:mrSessionData', 'xnat:mrScanData'
+    elif match.group(1) == 'CT' or match.group(1) == 'CTREF':
+        return '', 'xnat:ctSessionData', 'xnat:ctScanData'
+    elif match.group(1) == 'RT':
+        return '', 'xnat:rtSessionData', 'xnat:rtScanData'
+    return '', 'xnat:mrSessionData', 'xnat:mrScanData'
+
+
+def _changed_files(files, remote_files):
+    """
+    Returns the local files that are not in the list of remote file rows
+    (Name, digest) or whose MD5 digest is different
+    """
+    remote_digests = dict((r['Name'], r.get('digest')) for r in remote_files)
+    changed = []
+    for fname in files:
+        remote_digest = remote_digests.get(os.path.basename(fname).replace(' ', '%20'))
+        if remote_digest is None or remote_digest != md5_digest(fname):
+            changed.append(fname)
+    return changed
+
+
+def plan_upload(interface, project, subject, sessions, sub_folder, processed=False,
+                bundle_dicoms=False):
+    """
+    Creates the subject and the missing experiments on XNAT and returns the
+    list of the scans to upload. The experiments already on XNAT are found
+    with a single listing of the subject, and the files already in each of
+    them with one listing per experiment. Only the files that are missing on
+    XNAT, or whose MD5 digest is different from the local one, are planned
+    for upload, so partially uploaded scans are completed and uploading a
+    result tree again only sends the files that changed.
+
+    Each scan is returned as a list [experiment_uri, scan_name, scan_type,
+    resource_format, files, create] that can be passed to upload_scan (and
+    stored as JSON), where create lists the objects ('scan', 'resource')
+    that do not exist on XNAT yet.
+    """
+    uri = '/data/projects/%s/subjects/%s'%(project, subject)
+    response = _put(interface, 'create subject ' + subject, uri)
     subject_uid = response.content
     print('New subject %s created!' %subject_uid)
 
-    xnat_subs = interface.select.project(project).subjects()
-    xnat_sub = [x for x in xnat_subs if x.label() == subject][0]
-    sub_id = interface.select.project(project).subject(xnat_sub.id())
+    existing = dict((r['label'], r['ID']) for r in list_json(
+        interface, uri + '/experiments', columns='ID,label'))
 
+    jobs = []
     for session in sessions:
         print('Processing session {}'.format(session))
         session_folder = os.path.join(sub_folder, session)
-        scans = [x for x in sorted(glob.glob(session_folder+'/*')) if os.path.isfile(x)]
-        match = session_modality_re.match(session)
-        proc = ''
-        if match is None and processed:
-            experiment_type = 'xnat:mrSessionData'
-            scan_type = 'xnat:mrScanData'
-            proc = '_processed'
-        elif match.group(1) == 'MR':
-            experiment_type = 'xnat:mrSessionData'
-            scan_type = 'xnat:mrScanData'
-        elif match.group(1) == 'CT' or match.group(1) == 'CTREF':
-            experiment_type = 'xnat:ctSessionData'
-            scan_type = 'xnat:ctScanData'
-        elif match.group(1) == 'RT':
-            experiment_type = 'xnat:rtSessionData'
-            scan_type = 'xnat:rtScanData'
-        
-        experiment = sub_id.experiment('%s_%s%s'%(xnat_sub.label(), session, proc))
-        if not experiment.exists():
-            try:
-                experiment.create(experiments=experiment_type)
-            except DatabaseError:
-                experiment.create(experiments=experiment_type)
-            print('New experiment %s created!' %experiment.id())
-
-        for scan in scans:
-
-            _, scan_name, extention = split_filename(scan)
-            res_format = get_resource_name(scan)
-        #     scan_name = scan.split('/')[-1].split('.')[0]
-            print('Uploading {}...'.format(scan_name))
-            xnat_scan = experiment.scan(scan_name)
-            if not xnat_scan.exists():
-                done = False
-                z = 1
-                while not done:
-                    try:
-                        xnat_scan.create(scans=scan_type)
-                        done = True
-                    except DatabaseError:
-                        print('Same Database error: {} times'.format(z))
-                        z = z+1
-        #                 xnat_scan.create(scans=scan_type)
-                print('New scan %s created!' %xnat_scan.id())
-                resource = xnat_scan.resource(res_format)
-                if not resource.exists():
-                    try:
-                        resource.create()
-                    except DatabaseError:
-                        resource.create()
-                    print('New resource %s created!' %resource.id())
-                else:
-                    print('Resource %s already in the repository!' %resource.id())
-                xnat_resource = resource.file(scan_name+extention)
-                response = xnat_resource.put(src=scan, format=res_format,
-                                             content=res_format, extract=False, overwrite=True)
+        proc, experiment_type, scan_type = _session_types(session, processed)
+        experiment = '%s_%s%s'%(subject, session, proc)
+        experiment_uri = '{}/experiments/{}'.format(uri, experiment)
+        if experiment in existing:
+            remote = list_experiment_files(interface, existing[experiment])
+        else:
+            _put(interface, 'create experiment ' + experiment, experiment_uri,
+                 params={'xsiType': experiment_type})
+            print('New experiment %s created!' %experiment)
+            remote = {}
+
+        scans = []
+        for scan in [x for x in sorted(glob.glob(session_folder+'/*')) if os.path.isfile(x)]:
+            _, scan_name, _ = split_filename(scan)
+            scans.append((scan_name, get_resource_name(scan), [scan]))
+        if bundle_dicoms:
+            dicom_dirs = [x for x in sorted(glob.glob(session_folder+'/*')) if os.path.isdir(x)]
+        else:
+            dicom_dirs = []
+        for dicom_dir in dicom_dirs:
+            dicoms = [os.path.join(dicom_dir, x) for x in sorted(os.listdir(dicom_dir))
+                      if not x.startswith('.')
+                      and os.path.isfile(os.path.join(dicom_dir, x))]
+            if dicoms:
+                scans.append((os.path.basename(dicom_dir), 'DICOM', dicoms))
+
+        for scan_name, res_format, files in scans:
+            create = []
+            if scan_name not in remote:
+                create.append('scan')
+            if res_format not in remote.get(scan_name, {}):
+                create.append('resource')
             else:
-                print('Scan %s already in the repository!' %xnat_scan.id())
+                files = _changed_files(files, remote[scan_name][res_format])
+                if not files:
+                    print('Scan %s already in the repository!' %scan_name)
+                    continue
+                print('{0} file(s) of scan {1} missing or changed on XNAT'
+                      .format(len(files), scan_name))
+            jobs.append([experiment_uri, scan_name, scan_type, res_format, files,
+                         create])
+    return jobs
+
 
-#     else:
-#         print('Experiment %s already in the repository' %experiment.id())
+def upload_scan(interface, job):
+    """
+    Creates a scan planned by plan_upload, with its resource, if they do not
+    exist yet, and uploads its files
+    """
+    experiment_uri, scan_name, scan_type, res_format, files = job[:5]
+    create = job[5] if len(job) > 5 else ['scan', 'resource']
+    scan_uri = '{}/scans/{}'.format(experiment_uri, scan_name)
+    resource_uri = '{}/resources/{}'.format(scan_uri, res_format)
+    if 'scan' in create:
+        _put(interface, 'create scan ' + scan_name, scan_uri,
+             params={'xsiType': scan_type})
+    if 'resource' in create:
+        _put(interface, 'create resource ' + res_format, resource_uri)
+    if res_format == 'DICOM' and len(files) > 1:
+        print('Uploading {0} DICOM files for {1}...'.format(len(files), scan_name))
+        put_zip(interface, resource_uri, files, scan_name+'.zip')
+    else:
+        print('Uploading {}...'.format(scan_name))
+        digest = upload_file(interface, resource_uri, files[0], res_format)
+        check_digests(interface, resource_uri, {files[0]: digest})
+    print('Scan {} uploaded'.format(scan_name))
+
+
+def put(project, subject, sessions, sub_folder, config=None, url=None, pwd=None, user=None,
+        processed=False, bundle_dicoms=False, num_threads=1):
+    """Function to upload the scans of one subject. Each file in
+    sub_folder/session is uploaded as one scan. If bundle_dicoms is True,
+    each sub-directory of sub_folder/session is considered a DICOM scan and
+    all its files are uploaded in a single zip archive request, instead of
+    being ignored.
+    The missing experiments are created first (see plan_upload), then the
+    files that are missing on XNAT, or that changed locally, are uploaded by
+    num_threads workers.
+    """
+    interface = get_interface(server=url, user=user, password=pwd,
+                              config=config, proxy='www-int2:80')
+    jobs = plan_upload(interface, project, subject, sessions, sub_folder,
+                       processed=processed, bundle_dicoms=bundle_dicoms)
+
+    # Errors are reported for each scan and the first one is raised once all
+    # the other scans have been uploaded
+    if num_threads > 1 and len(jobs) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = [executor.submit(upload_scan, interface, job) for job in jobs]
+        errors = []
+        for job, future in zip(jobs, futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('Could not upload scan {0}: {1}'.format(job[1], e))
+                errors.append(e)
+        if errors:
+            raise errors[0]
+    else:
+        for job in jobs:
+            upload_scan(interface, job)
+
+
+def _session_name(label):
+    "Returns the name of the session folder from the XNAT session label"
+    if len(label.split('_')) == 3:
+        return label.split('_')[1]
+    elif len(label.split('_')) == 4:
+        return label.split('_')[2]
+    print('WARNING: The session name seems to be different from '
+          'the convention used in the current workflow. It will be '
+          'taken equal to the session label from XNAT.')
+    return label
+
+
+def _load_manifest(manifest_file):
+    """
+    Returns the files (relative to the download directory) that were
+    completely downloaded according to the manifest of a previous run, with
+    the digest, size and modification time they had when they were recorded
+    """
+    completed = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    completed[entry['path']] = entry
+                except (ValueError, KeyError):
+                    # last line may be truncated if the previous run crashed
+                    continue
+    return completed
+
+
+def _stream(interface, file_uri, f):
+    "Streams a remote file into the file object f"
+    response = interface.get(file_uri, stream=True)
+    check_response(interface, response)
+    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+        f.write(chunk)
 
 
 def get(project_id, cache_dir, config=None, url=None, pwd=None, user=None, processed=True,
-        subjects=[]):
-    "Function to download ALL the subject/sessions/scans from one project."
-    "If processed=True, only the processed sessions will be downloaded, "
-    "otherwise only the not-processed (i.e. the sessions with raw data)."
+        subjects=[], num_threads=1, retries=3):
+    """Function to download ALL the subject/sessions/scans from one project.
+    If processed=True, only the processed sessions will be downloaded,
+    otherwise only the not-processed (i.e. the sessions with raw data).
+    The whole project tree is listed first, with a few bulk requests (see
+    basecore.database.catalog.ProjectCatalog), and then the files are downloaded
+    by num_threads workers, each file being tried up to retries times. The
+    files already present in cache_dir are downloaded again only if their
+    MD5 digest does not match the one on XNAT (i.e. they are incomplete or
+    they were updated on the server). The files completed are recorded in a
+    manifest in cache_dir, so that an interrupted download can be restarted
+    where it stopped without checking their digests again.
+    """
     failed = []
+    policy = get_policy(retries)
 
-    if config is not None:
-        interface = Interface(config)
-    else:
-        interface = Interface(server=url, user=user,password=pwd,
-                              proxy='www-int2:80')
+    interface = get_interface(server=url, user=user, password=pwd,
+                              config=config, proxy='www-int2:80')
 
-    xnat_subjects = interface.select.project(project_id).subjects().get()
-    xnat_sub_labels = [interface.select.project(project_id).subject(x).label()
-                       for x in xnat_subjects]
-    print('Found {0} subjects in project {1}'.format(len(xnat_subjects), project_id))
+    catalog = ProjectCatalog(interface, project_id)
+    xnat_sub_labels = list(catalog.subjects.keys())
+    print('Found {0} subjects in project {1}'.format(len(xnat_sub_labels), project_id))
     # check to see if the requested subjects are on XNAT
     if subjects:
-        if not set(subjects).issubset(xnat_sub_labels):
-            unprocessed = [x for x in subjects if x not in xnat_sub_labels]
+        requested = [catalog.subject_label(x) or x for x in subjects]
+        if not set(requested).issubset(xnat_sub_labels):
+            unprocessed = [x for x in requested if x not in xnat_sub_labels]
             print('The following subjects are not present in project {0} on XNAT'
                   ' and will be ignored: {1}'
                   .format(project_id, '\n'.join(unprocessed)))
-            xnat_subjects = [x for x in subjects if x not in unprocessed]
+            xnat_subjects = [x for x in requested if x not in unprocessed]
         else:
-            xnat_subjects = subjects
+            xnat_subjects = requested
             print('All the requested subjects were found on XNAT.')
     else:
+        xnat_subjects = xnat_sub_labels
         print('Since no subjects were specified, all subjects will be downloaded')
 
-    for sub_id in xnat_subjects:
-        xnat_sub = interface.select.project(project_id).subject(sub_id)
-        sub_name = xnat_sub.label()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    manifest_file = os.path.join(cache_dir, DOWNLOAD_MANIFEST)
+    completed = _load_manifest(manifest_file)
+    if completed:
+        print('Found a download manifest with {} files in {}. Those files will '
+              'not be downloaded again unless they changed.'
+              .format(len(completed), cache_dir))
+
+    # list all the files to download before starting. Files are saved as
+    # subject/session/name, so only the first file with a given name in each
+    # session is downloaded (two workers must never write the same path)
+    to_download = []
+    destinations = {}
+    for sub_name in xnat_subjects:
+        sessions = catalog.experiments[sub_name]
         if processed:
-            sessions = [x for x in xnat_sub.experiments().get()
-                        if 'processed' in xnat_sub.experiment(x).label()]
-            print('\nFound {0} processed sessions for subject {1}'.format(len(sessions), sub_name))
+            sessions = [x for x in sessions.values() if 'processed' in x['label']]
+            print('Found {0} processed sessions for subject {1}'.format(len(sessions), sub_name))
         else:
-            sessions = xnat_sub.experiments().get()
+            sessions = list(sessions.values())
             print('Found {0} sessions for subject {1}'.format(len(sessions), sub_name))
 
-        for session_id in sessions:
-            xnat_session = xnat_sub.experiment(session_id)
-            if len(xnat_session.label().split('_')) == 3:
-                session_name = xnat_session.label().split('_')[1]
-            elif len(xnat_session.label().split('_')) == 4:
-                session_name = xnat_session.label().split('_')[2]
-            else:
-                print('WARNING: The session name seems to be different from '
-                      'the convention used in the current workflow. It will be '
-                      'taken equal to the session label from XNAT.')
-                session_name = xnat_session.label().split('_')
-
-            print('\nProcessing session {}\n'.format(session_name))
-            folder_path = os.path.join(cache_dir, sub_name, session_name)
-            if not os.path.isdir(folder_path):
-                os.makedirs(folder_path)
-            else:
-                print('{} already exists. This might mean that you are trying to '
-                      'restart a job, so I will check for already downloaded resources '
-                      'in order to speed up the process.'.format(folder_path))
-            scans = xnat_session.scans().get()
-            for scan_id in scans:
-                xnat_scan = xnat_session.scan(scan_id)
-                resources = xnat_scan.resources().get()
-                for res_id in resources:
-                    xnat_resource = xnat_scan.resource(res_id)
-                    files = xnat_resource.files().get()
-                    for file_id in files:
-                        downloaded = False
-                        scan_name = xnat_resource.file(file_id).label()
-                        if not os.path.isfile(os.path.join(folder_path, scan_name)):
-                            print('Downloading resource {} ...'.format(scan_name))
-                            while not downloaded:
-                                try:
-                                    xnat_resource.file(file_id).get_copy(
-                                        os.path.join(folder_path, scan_name))
-                                    downloaded = True
-                                except ConnectionError:
-                                    print('Connection lost during download. Try again...')
-                                except:
-                                    print('Could not download {0} for session {1} '
-                                          'in subject {2}. Please try again later'
-                                          .format(scan_name, session_name, sub_name))
-                                    failed.append([sub_name, session_name, scan_name])
-                        else:
-                            print('{} already downloaded, skiping it.'.format(scan_name))
+        for xnat_session in sessions:
+            session_name = _session_name(xnat_session['label'])
+            for resources in catalog.files(xnat_session).values():
+                for files in resources.values():
+                    for xnat_file in files:
+                        scan_name = xnat_file['Name']
+                        rel_path = os.path.join(sub_name, session_name, scan_name)
+                        if rel_path in destinations:
+                            print('WARNING: {0} and {1} would both be saved as {2}, '
+                                  'only the first one will be downloaded.'.format(
+                                      destinations[rel_path], xnat_file['URI'], rel_path))
+                            continue
+                        destinations[rel_path] = xnat_file['URI']
+                        to_download.append(
+                            (xnat_file['URI'], rel_path, xnat_file.get('digest') or None))
+    print('Found {0} files to synchronise'.format(len(to_download)))
+
+    manifest_lock = threading.Lock()
+
+    def record(rel_path, file_uri, digest):
+        st = os.stat(os.path.join(cache_dir, rel_path))
+        entry = {'path': rel_path, 'uri': file_uri, 'digest': digest,
+                 'size': st.st_size, 'mtime': st.st_mtime_ns}
+        with manifest_lock:
+            with open(manifest_file, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def is_downloaded(rel_path, file_uri, digest):
+        path = os.path.join(cache_dir, rel_path)
+        if not os.path.isfile(path):
+            return False
+        if digest is None:
+            # no digest on XNAT to compare with
+            return True
+        entry = completed.get(rel_path)
+        st = os.stat(path)
+        if (entry is not None and entry.get('digest') == digest
+                and entry.get('size') == st.st_size
+                and entry.get('mtime') == st.st_mtime_ns):
+            return True
+        if md5_digest(path) == digest:
+            record(rel_path, file_uri, digest)
+            return True
+        print('{} is incomplete or was updated on XNAT, it will be downloaded '
+              'again.'.format(rel_path))
+        return False
+
+    def download(job):
+        file_uri, rel_path, digest = job
+        path = os.path.join(cache_dir, rel_path)
+        try:
+            if is_downloaded(rel_path, file_uri, digest):
+                return 'skipped'
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            print('Downloading resource {} ...'.format(rel_path))
+            download_file(lambda f: _stream(interface, file_uri, f), path,
+                          policy=policy, digest=digest)
+        except Exception as e:
+            print('Could not download {0}: {1}. Please try again later'
+                  .format(rel_path, e))
+            return rel_path
+        record(rel_path, file_uri, digest)
+        return 'downloaded'
+
+    if num_threads > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = list(executor.map(download, to_download))
+    else:
+        results = [download(job) for job in to_download]
+    failed = [x for x in results if x not in ('skipped', 'downloaded')]
+    print('{0} files downloaded, {1} already up to date, {2} failed'
+          .format(results.count('downloaded'), results.count('skipped'), len(failed)))
+
     if failed:
         with open(cache_dir+'/failed_download.txt', 'w') as f:
             for line in failed:
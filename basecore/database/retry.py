@@ -0,0 +1,175 @@
+import re
+import time
+import random
+import socket
+import threading
+from collections import Counter
+from requests.exceptions import RequestException
+from xnat.exceptions import XNATResponseError, XNATUploadError, XNATAuthError
+from pyxnat.core.errors import DatabaseError
+
+
+# HTTP status codes that signal a transient problem of the server
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+
+# status code in the messages of XnatPy ('... (status 503)' and
+# 'Upload failed ... Status code 503, ...')
+status_re = re.compile(r'\(status (\d+)\)|status code (\d+)', re.IGNORECASE)
+# pyxnat errors that retrying cannot fix. Repeating a failed login, in
+# particular, may get the account locked by XNAT
+fatal_message_re = re.compile(r'authenticat|unauthori[sz]ed|forbidden|login|password|'
+                              r'not found|connection failed', re.IGNORECASE)
+# pyxnat errors raised when the login is rejected (e.g. the session expired)
+auth_message_re = re.compile(r'authenticat|unauthori[sz]ed|login|password', re.IGNORECASE)
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+def retry_stats():
+    """
+    Returns the counters of the network calls made through a RetryPolicy
+    since the start of the process (or the last reset):
+
+    - calls: calls that eventually succeeded
+    - retries: failed attempts that were repeated
+    - failures: calls that failed, either because the error was not
+      retryable or because all the attempts failed
+    - status_<code>: failed attempts that received the given HTTP status
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_retry_stats():
+    "Sets all the counters returned by retry_stats to zero"
+    with _stats_lock:
+        _stats.clear()
+
+
+def response_status(error):
+    """
+    Returns the HTTP status code that caused an exception raised by requests,
+    xnatpy or pyxnat, or None if the error did not come with a response
+    """
+    response = getattr(error, 'response', None)
+    if response is not None and getattr(response, 'status_code', None):
+        return response.status_code
+    if isinstance(error, (XNATResponseError, XNATUploadError, DatabaseError)):
+        match = status_re.search(str(error))
+        if match is not None:
+            return int(match.group(1) or match.group(2))
+    return None
+
+
+def is_retryable(error):
+    """
+    Whether an error is transient (connection problems, timeouts, server
+    overloaded) and the call that raised it should be repeated, or fatal
+    (e.g. wrong credentials, missing object, bad request)
+    """
+    status = response_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(error, DatabaseError) and fatal_message_re.search(str(error)):
+        return False
+    return isinstance(error, (RequestException, ConnectionError, TimeoutError,
+                              socket.timeout, DatabaseError))
+
+
+def is_auth_error(error):
+    """
+    Whether an error means that the server rejected the login of the session
+    (e.g. because it expired), so that the session cannot be used any more
+    """
+    status = response_status(error)
+    if status is not None:
+        return status == 401
+    if isinstance(error, XNATAuthError):
+        return True
+    return isinstance(error, DatabaseError) and auth_message_re.search(str(error)) is not None
+
+
+class RetryPolicy(object):
+    """Repeats calls to the XNAT server that fail with a transient error,
+    waiting an exponentially growing, randomly jittered, time between the
+    attempts. Fatal errors, and the last error when all the attempts fail,
+    are raised to the caller.
+
+    Parameters
+    ----------
+    attempts : int
+        Maximum number of attempts for each call
+    backoff : float
+        Time (in seconds) to wait after the first failed attempt. It doubles
+        after every attempt
+    max_backoff : float
+        Maximum time (in seconds) to wait between two attempts
+    jitter : float
+        Fraction of the waiting time that is randomised, so that concurrent
+        workers do not retry at the same time
+    """
+
+    def __init__(self, attempts=3, backoff=1.0, max_backoff=60.0, jitter=0.5):
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        "Time to wait after the given (1-based) failed attempt"
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, description, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs) until it succeeds, it raises a fatal
+        error or the maximum number of attempts is reached
+
+        Parameters
+        ----------
+        description : str
+            What the call does, used in the messages printed after a failure
+        func : callable
+            The function making the network call
+
+        Returns
+        -------
+        The value returned by func
+        """
+        for attempt in range(1, self.attempts + 1):
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                status = response_status(e)
+                if status is not None:
+                    _count('status_{}'.format(status))
+                if not is_retryable(e) or attempt == self.attempts:
+                    _count('failures')
+                    raise
+                _count('retries')
+                delay = self.delay(attempt)
+                print('Attempt {0} of {1} to {2} failed ({3}). Trying again in '
+                      '{4:.1f} s...'.format(attempt, self.attempts, description,
+                                            e, delay))
+                time.sleep(delay)
+            else:
+                _count('calls')
+                return result
+
+
+default_policy = RetryPolicy()
+
+
+def get_policy(retries=None):
+    "Returns the default policy, or one with the given number of attempts"
+    if retries is None:
+        return default_policy
+    return RetryPolicy(attempts=retries, backoff=default_policy.backoff,
+                       max_backoff=default_policy.max_backoff,
+                       jitter=default_policy.jitter)
@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from basecore.utils.sqlite_db import SQLiteDatabase
+from .pool import get_interface
+from .pyxnat import plan_upload, upload_scan
+
+
+# States of the subjects and of the scans in the queue
+PENDING = 'pending'
+PLANNED = 'planned'
+DONE = 'done'
+FAILED = 'failed'
+# subjects added again to the queue before their upload was completed
+SUPERSEDED = 'superseded'
+
+
+class UploadQueue(object):
+    """Persistent queue of subjects to upload to XNAT, drained by a pool of
+    background workers while the caller goes on processing the next subject.
+
+    The queue is stored in a SQLite database with one row per subject and,
+    once the subject and its experiments have been created on XNAT, one row
+    per scan to upload. Scans are marked as done as soon as they are
+    uploaded, so when the process is restarted (after a crash or on purpose)
+    the queue resumes with the scans that were not uploaded yet.
+
+    Passwords are never stored in the database: they are given to start()
+    and kept in memory only. After a restart, the subjects left in the queue
+    are uploaded once start() is called again with the same server and user.
+
+    Parameters
+    ----------
+    path : str
+        path to the SQLite database. It will be created if it does not exist
+    num_threads : int
+        Number of scans uploaded at the same time
+    poll_interval : float
+        Seconds the workers wait for new subjects when the queue is empty
+    """
+
+    def __init__(self, path, num_threads=4, poll_interval=5):
+        self.path = path
+        self.num_threads = num_threads
+        self.poll_interval = poll_interval
+        self._db = SQLiteDatabase(path, [
+            'CREATE TABLE IF NOT EXISTS subjects (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'url TEXT, user TEXT, project TEXT, subject TEXT, sub_folder TEXT, '
+            'sessions TEXT, processed INTEGER, state TEXT, error TEXT, created REAL)',
+            'CREATE TABLE IF NOT EXISTS scans (subject_id INTEGER, position INTEGER, '
+            'job TEXT, state TEXT, error TEXT, PRIMARY KEY (subject_id, position))'])
+        self._lock = threading.Lock()
+        self._credentials = {}
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._idle = threading.Event()
+        self._thread = None
+
+    def _execute(self, query, args=()):
+        with self._lock:
+            conn = self._db.connect()
+            with conn:
+                return conn.execute(query, args).fetchall()
+
+    def add(self, project, subject, sub_folder, sessions, url, user,
+            processed=True):
+        """
+        Adds a subject to the queue and returns immediately. If the subject is
+        already in the queue, and not completely uploaded, the previous entry
+        is marked as superseded and the subject is planned again, so that the
+        scans produced since it was added are uploaded as well. If the
+        previous entry is being uploaded, the workers skip the scans they did
+        not start yet.
+
+        Parameters
+        ----------
+        project : str
+            XNAT project ID
+        subject : str
+            The subject ID
+        sub_folder : str
+            Folder with the results of the subject
+        sessions : list
+            The sessions (sub-folders of sub_folder) to upload
+        url : str
+            URL of the XNAT server
+        user : str
+            The user to connect to the server with
+        processed : bool
+            Whether the results are processed data (see
+            basecore.database.pyxnat.put)
+
+        Returns
+        -------
+        int
+            The ID of the subject in the queue
+        """
+        with self._lock:
+            conn = self._db.connect()
+            with conn:
+                conn.execute(
+                    'UPDATE subjects SET state=? WHERE url=? AND user=? AND project=? '
+                    'AND subject=? AND state IN (?, ?, ?)',
+                    (SUPERSEDED, url, user, project, subject, PENDING, PLANNED, FAILED))
+                cursor = conn.execute(
+                    'INSERT INTO subjects (url, user, project, subject, sub_folder, '
+                    'sessions, processed, state, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (url, user, project, subject, os.path.abspath(sub_folder),
+                     json.dumps(sessions), int(processed), PENDING, time.time()))
+        self._idle.clear()
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def status(self):
+        """
+        Returns the number of subjects in each state (pending, planned, done,
+        failed and superseded)
+        """
+        return dict(self._execute('SELECT state, COUNT(*) FROM subjects GROUP BY state'))
+
+    def failed(self):
+        """
+        Returns the subjects whose upload failed, as a list of tuples
+        (project, subject, error)
+        """
+        return self._execute('SELECT project, subject, error FROM subjects '
+                             'WHERE state=? ORDER BY id', (FAILED,))
+
+    def retry_failed(self):
+        "Puts the failed subjects back in the queue"
+        self._execute('UPDATE scans SET state=?, error=NULL WHERE state=? AND '
+                      'subject_id IN (SELECT id FROM subjects WHERE state=?)',
+                      (PENDING, FAILED, FAILED))
+        self._execute('UPDATE subjects SET state=CASE WHEN EXISTS (SELECT 1 FROM '
+                      'scans WHERE subject_id=subjects.id) THEN ? ELSE ? END, '
+                      'error=NULL WHERE state=?', (PLANNED, PENDING, FAILED))
+        self._idle.clear()
+        self._wakeup.set()
+
+    def _next_subject(self):
+        with self._lock:
+            keys = list(self._credentials)
+        for url, user in keys:
+            rows = self._execute(
+                'SELECT id, project, subject, sub_folder, sessions, processed, state '
+                'FROM subjects WHERE url=? AND user=? AND state IN (?, ?) '
+                'ORDER BY id LIMIT 1', (url, user, PENDING, PLANNED))
+            if rows:
+                return (url, user) + tuple(rows[0])
+        return None
+
+    def _upload_subject(self, executor, url, user, subject_id, project, subject,
+                        sub_folder, sessions, processed, state):
+        interface = get_interface(server=url, user=user, password=self._credentials[(url, user)],
+                                  proxy='www-int2:80')
+        if state == PENDING:
+            # creates the subject and its experiments and stores the scans to
+            # upload. If the process stops before this is committed, the subject
+            # is planned again at the next start
+            jobs = plan_upload(interface, project, subject, json.loads(sessions),
+                               sub_folder, processed=bool(processed))
+            with self._lock:
+                conn = self._db.connect()
+                with conn:
+                    conn.execute('DELETE FROM scans WHERE subject_id=?', (subject_id,))
+                    conn.executemany(
+                        'INSERT INTO scans VALUES (?, ?, ?, ?, NULL)',
+                        [(subject_id, i, json.dumps(job), PENDING)
+                         for i, job in enumerate(jobs)])
+                    conn.execute('UPDATE subjects SET state=? WHERE id=? AND state=?',
+                                 (PLANNED, subject_id, PENDING))
+
+        rows = self._execute('SELECT position, job FROM scans WHERE subject_id=? '
+                             'AND state!=? ORDER BY position', (subject_id, DONE))
+
+        def upload(position, job):
+            # the subject may have been added again since its upload started
+            if self._is_superseded(subject_id):
+                return False
+            try:
+                upload_scan(interface, json.loads(job))
+            except Exception as e:
+                self._execute('UPDATE scans SET state=?, error=? WHERE subject_id=? '
+                              'AND position=?', (FAILED, str(e), subject_id, position))
+                raise
+            self._execute('UPDATE scans SET state=?, error=NULL WHERE subject_id=? '
+                          'AND position=?', (DONE, subject_id, position))
+            return True
+
+        futures = [executor.submit(upload, position, job) for position, job in rows]
+        errors = []
+        skipped = 0
+        for future in futures:
+            try:
+                if not future.result():
+                    skipped += 1
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return skipped
+
+    def _is_superseded(self, subject_id):
+        return self._execute('SELECT state FROM subjects WHERE id=?',
+                             (subject_id,)) == [(SUPERSEDED,)]
+
+    def run(self):
+        """
+        Uploads the subjects in the queue, waiting for new ones when it is
+        empty, until stop() is called
+        """
+        with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+            while not self._stop.is_set():
+                self._wakeup.clear()
+                try:
+                    item = self._next_subject()
+                except (sqlite3.Error, OSError) as e:
+                    print('Could not read the upload queue {0} ({1}).'.format(self.path, e))
+                    item = None
+                if item is None:
+                    self._idle.set()
+                    self._wakeup.wait(self.poll_interval)
+                    continue
+                url, user, subject_id, project, subject = item[:5]
+                print('Uploading subject {} to XNAT...'.format(subject))
+                # a subject superseded meanwhile keeps that state, its new
+                # entry is uploaded next
+                try:
+                    skipped = self._upload_subject(executor, *item)
+                except Exception as e:
+                    self._execute('UPDATE subjects SET state=?, error=? WHERE id=? '
+                                  'AND state!=?', (FAILED, str(e), subject_id, SUPERSEDED))
+                    print('Could not upload subject {0} ({1}). It can be uploaded '
+                          'again with UploadQueue.retry_failed().'.format(subject, e))
+                else:
+                    if self._is_superseded(subject_id):
+                        print('Subject {0} was added to the queue again, {1} of its '
+                              'scans were left to the new upload.'.format(subject, skipped))
+                        continue
+                    self._execute('UPDATE subjects SET state=?, error=NULL WHERE id=? '
+                                  'AND state!=?', (DONE, subject_id, SUPERSEDED))
+                    print('Subject {} successfully uploaded.'.format(subject))
+
+    def start(self, url, user, pwd):
+        """
+        Starts the background workers, if they are not running yet, and lets
+        them upload the subjects queued for the given server and user,
+        including the ones left in the queue by a previous run
+        """
+        with self._lock:
+            self._credentials[(url, user)] = pwd
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._idle.clear()
+                self._thread = threading.Thread(target=self.run, name='xnat-upload-queue')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wakeup.set()
+
+    def join(self, timeout=None):
+        """
+        Waits until the workers have gone through all the subjects they can
+        upload (the failed ones are left in the queue). Returns False if the
+        timeout expired first, or if the workers stopped (see stop) before
+        the queue was empty
+        """
+        if self._thread is None:
+            return True
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            # the workers may have stopped, or died, without going idle
+            if not self._thread.is_alive():
+                return self._next_subject() is None
+            wait = self.poll_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return False
+            if not self._idle.wait(wait):
+                continue
+            # a subject may have been added just before the workers went idle
+            if self._next_subject() is None:
+                return True
+            self._idle.clear()
+            self._wakeup.set()
+
+    def stop(self):
+        """Stops the workers once the subject being uploaded is done. The
+        subjects still in the queue will be uploaded at the next start"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
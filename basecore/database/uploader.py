@@ -0,0 +1,280 @@
+import os
+import re
+import sys
+import time
+import errno
+import shutil
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# inotify events that signal a new entry in the spool directory
+IN_CREATE = 0x00000100
+IN_MOVED_TO = 0x00000080
+_event_header = struct.Struct('iIII')
+
+# Sub-directories of the spool directory used by spool_subject and
+# UploadService. Names starting with '.' are never uploaded.
+INCOMING_DIR = '.incoming'
+FAILED_DIR = '.failed'
+# Marker folder created next to the subject by the scripts that spooled one
+# subject at a time (previous layout). It is not a subject
+READY_MARKER = 'ready'
+# Each spooled job is named <sub_id>.<timestamp in microseconds>
+job_re = re.compile(r'(?P<sub_id>.+)\.(?P<stamp>\d+)$')
+
+
+def _parse_job(job):
+    """
+    Returns the subject ID of a spooled job and the folder that contains
+    the results of the subject (as spool_dir/job/sub_id). Folders named
+    after the subject only, spooled by previous versions, are supported as
+    well
+    """
+    match = job_re.match(job)
+    if match is None:
+        return job, job, 0
+    return match.group('sub_id'), job, int(match.group('stamp'))
+
+
+def spool_subject(src_dir, spool_dir, sub_id):
+    """
+    Adds the results of a subject to the upload spool. The results are copied
+    to a hidden folder inside spool_dir first and then renamed to
+    spool_dir/<sub_id>.<timestamp>/sub_id, so the UploadService watching
+    spool_dir only sees complete subjects. It never waits for previous
+    uploads to finish: if the subject is already in the spool, the new
+    results are uploaded after the previous ones (or instead of them, if
+    their upload did not start yet).
+
+    Parameters
+    ----------
+    src_dir : str
+        Folder with the results of the subject (one sub-folder per session)
+    spool_dir : str
+        The spool directory watched by the UploadService
+    sub_id : str
+        The subject ID
+
+    Returns
+    -------
+    str
+        The name of the job in the spool
+    """
+    job = '{0}.{1}'.format(sub_id, int(time.time() * 1e6))
+    incoming = os.path.join(spool_dir, INCOMING_DIR, job)
+    if os.path.isdir(incoming):
+        shutil.rmtree(incoming)
+    shutil.copytree(src_dir, os.path.join(incoming, sub_id))
+    os.rename(incoming, os.path.join(spool_dir, job))
+    return job
+
+
+class _Inotify(object):
+    "Minimal inotify watch of one directory, through ctypes"
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        if libc.inotify_add_watch(self.fd, path.encode(),
+                                  IN_CREATE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch failed for {}'.format(path))
+
+    def read(self):
+        "Returns the names of the new entries, once self.fd is readable"
+        data = os.read(self.fd, 65536)
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = _event_header.unpack_from(data, offset)
+            offset += _event_header.size
+            names.append(data[offset:offset + length].rstrip(b'\0').decode())
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class UploadService(object):
+    """Uploads the subjects added to a spool directory (see spool_subject),
+    several at a time. New subjects are detected with inotify, falling back
+    to polling the directory where inotify is not available. Each subject is
+    removed from the spool once uploaded, or moved to spool_dir/.failed if
+    the upload fails.
+
+    Parameters
+    ----------
+    spool_dir : str
+        The directory to watch
+    upload : callable
+        Function called as upload(sub_id, results_dir) to upload one subject,
+        whose results are in results_dir/sub_id, e.g. a wrapper around
+        basecore.workflows.datahandler.xnat_datasink
+    num_threads : int
+        Number of subjects uploaded at the same time
+    poll_interval : float
+        Seconds between two scans of the spool directory when polling. With
+        inotify the directory is also rescanned at this interval, in case an
+        event was missed. The spool is also rescanned as soon as an upload
+        finishes, to start the jobs that were waiting for it
+    use_inotify : bool
+        Whether to try inotify before falling back to polling
+    """
+
+    def __init__(self, spool_dir, upload, num_threads=2, poll_interval=60,
+                 use_inotify=True):
+        self.spool_dir = spool_dir
+        self.upload = upload
+        self.num_threads = num_threads
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        # subjects being uploaded, and jobs that could not be moved out of the
+        # spool after a failed upload
+        self._running = set()
+        self._stuck = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # pipe written to wake up the service loop, see _wakeup
+        self._wakeup_fds = None
+
+    def pending(self):
+        """
+        Returns the jobs in the spool that can be uploaded now: the latest job
+        of each subject that is not being uploaded. Older jobs of those
+        subjects are superseded and removed from the spool; the jobs of the
+        subjects being uploaded wait for the running upload to finish
+        """
+        latest = {}
+        with self._lock:
+            for job in os.listdir(self.spool_dir):
+                if (job.startswith('.') or job == READY_MARKER or job in self._stuck
+                        or not os.path.isdir(os.path.join(self.spool_dir, job))):
+                    continue
+                sub_id, _, stamp = _parse_job(job)
+                if sub_id in self._running:
+                    continue
+                if sub_id in latest:
+                    old_stamp, old_job = latest[sub_id]
+                    if old_stamp > stamp:
+                        stamp, job, old_job = old_stamp, old_job, job
+                    print('Results {0} of subject {1} were replaced by {2} before '
+                          'being uploaded.'.format(old_job, sub_id, job))
+                    shutil.rmtree(os.path.join(self.spool_dir, old_job))
+                latest[sub_id] = (stamp, job)
+        return sorted(job for _, job in latest.values())
+
+    def _upload(self, job):
+        sub_id, _, stamp = _parse_job(job)
+        job_dir = os.path.join(self.spool_dir, job)
+        # results spooled by previous versions are in spool_dir/sub_id
+        results_dir = job_dir if stamp else self.spool_dir
+        try:
+            print('Uploading subject {} to XNAT...'.format(sub_id))
+            self.upload(sub_id, results_dir)
+        except Exception as e:
+            failed_dir = os.path.join(self.spool_dir, FAILED_DIR)
+            try:
+                if not os.path.isdir(failed_dir):
+                    os.makedirs(failed_dir)
+                if os.path.isdir(os.path.join(failed_dir, job)):
+                    shutil.rmtree(os.path.join(failed_dir, job))
+                os.rename(job_dir, os.path.join(failed_dir, job))
+            except OSError as move_error:
+                with self._lock:
+                    self._stuck.add(job)
+                print('Could not upload subject {0} ({1}) and could not move the '
+                      'results to {2} ({3}). They will be left in {4} and not '
+                      'uploaded again until the service is restarted.'
+                      .format(sub_id, e, failed_dir, move_error, job_dir))
+            else:
+                print('Could not upload subject {0} ({1}). The results were moved '
+                      'to {2}.'.format(sub_id, e, failed_dir))
+        else:
+            shutil.rmtree(job_dir)
+            print('Subject {} successfully uploaded.'.format(sub_id))
+        finally:
+            with self._lock:
+                self._running.discard(sub_id)
+            # the next job of the subject may be waiting in the spool
+            self._wakeup()
+
+    def _wakeup(self):
+        "Makes the service loop rescan the spool without waiting for poll_interval"
+        with self._lock:
+            if self._wakeup_fds is not None:
+                try:
+                    os.write(self._wakeup_fds[1], b'\0')
+                except BlockingIOError:
+                    # the pipe is full, a wakeup is already pending
+                    pass
+
+    def _submit_pending(self, executor):
+        for job in self.pending():
+            with self._lock:
+                self._running.add(_parse_job(job)[0])
+            executor.submit(self._upload, job)
+
+    def _watch(self):
+        if self.use_inotify and sys.platform.startswith('linux'):
+            try:
+                return _Inotify(self.spool_dir)
+            except (OSError, AttributeError) as e:
+                print('Could not watch {0} with inotify ({1}), it will be polled '
+                      'every {2} seconds.'.format(self.spool_dir, e,
+                                                  self.poll_interval))
+        return None
+
+    def run(self):
+        """
+        Uploads the subjects already in the spool and then the new ones as
+        they are added, until stop() is called
+        """
+        for folder in (self.spool_dir, os.path.join(self.spool_dir, INCOMING_DIR)):
+            try:
+                os.makedirs(folder)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        watch = self._watch()
+        wakeup_fd, wakeup_write_fd = os.pipe()
+        os.set_blocking(wakeup_write_fd, False)
+        self._wakeup_fds = (wakeup_fd, wakeup_write_fd)
+        fds = [wakeup_fd] if watch is None else [wakeup_fd, watch.fd]
+        try:
+            with ThreadPoolExecutor(max_workers=self.num_threads) as executor:
+                while not self._stop.is_set():
+                    self._submit_pending(executor)
+                    ready, _, _ = select.select(fds, [], [], self.poll_interval)
+                    if wakeup_fd in ready:
+                        os.read(wakeup_fd, 4096)
+                    if watch is not None and watch.fd in ready:
+                        watch.read()
+        finally:
+            with self._lock:
+                self._wakeup_fds = None
+            os.close(wakeup_fd)
+            os.close(wakeup_write_fd)
+            if watch is not None:
+                watch.close()
+
+    def start(self):
+        "Runs the service in a background thread and returns the thread"
+        thread = threading.Thread(target=self.run, name='xnat-upload-service')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stops watching the spool, after the running uploads have
+        finished"""
+        self._stop.set()
+        self._wakeup()
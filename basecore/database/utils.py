@@ -1,15 +1,23 @@
 from .base import connect, resource_exts, find_executable 
 from .exceptions import (
     XnatUtilsUsageError, XnatUtilsError,
-    XnatUtilsMissingResourceException)
+    XnatUtilsMissingResourceException, XnatUtilsDigestCheckError)
 import os
+import io
 import errno
 import re
 import shutil
+import hashlib
+import zipfile
+from .retry import default_policy
 from xnat.exceptions import XNATResponseError
 import subprocess as sp
 
 
+# Size of the chunks used to read files when computing their digests
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
 def varput(subject_or_session_id, variable, value, **kwargs):
     """
     Sets variables (custom or otherwise) of a session or subject in a MBI-XNAT
@@ -52,16 +60,21 @@ def varput(subject_or_session_id, variable, value, **kwargs):
     with connect(**kwargs) as login:
         # Get XNAT object to set the field of
         if subject_or_session_id.count('_') == 1:
-            xnat_obj = login.subjects[subject_or_session_id]
+            xnat_obj = default_policy.call(
+                'find subject ' + subject_or_session_id,
+                lambda: login.subjects[subject_or_session_id])
         elif subject_or_session_id.count('_') >= 2:
-            xnat_obj = login.experiments[subject_or_session_id]
+            xnat_obj = default_policy.call(
+                'find session ' + subject_or_session_id,
+                lambda: login.experiments[subject_or_session_id])
         else:
             raise XnatUtilsUsageError(
                 "Invalid ID '{}' for subject or sessions (must contain one "
                 "underscore  for subjects and two underscores for sessions)"
                 .format(subject_or_session_id))
         # Set value
-        xnat_obj.fields[variable] = value
+        default_policy.call('set ' + variable, xnat_obj.fields.__setitem__,
+                            variable, value)
 
 
 def varget(subject_or_session_id, variable, default='', **kwargs):
@@ -106,9 +119,13 @@ def varget(subject_or_session_id, variable, default='', **kwargs):
     with connect(**kwargs) as login:
         # Get XNAT object to set the field of
         if subject_or_session_id.count('_') == 1:
-            xnat_obj = login.subjects[subject_or_session_id]
+            xnat_obj = default_policy.call(
+                'find subject ' + subject_or_session_id,
+                lambda: login.subjects[subject_or_session_id])
         elif subject_or_session_id.count('_') >= 2:
-            xnat_obj = login.experiments[subject_or_session_id]
+            xnat_obj = default_policy.call(
+                'find session ' + subject_or_session_id,
+                lambda: login.experiments[subject_or_session_id])
         else:
             raise XnatUtilsUsageError(
                 "Invalid ID '{}' for subject or sessions (must contain one "
@@ -116,18 +133,20 @@ def varget(subject_or_session_id, variable, default='', **kwargs):
                 .format(subject_or_session_id))
         # Get value
         try:
-            return xnat_obj.fields[variable]
+            return default_policy.call('get ' + variable,
+                                       lambda: xnat_obj.fields[variable])
         except KeyError:
             return default
 
 
-def get_digests(resource):
+def get_digests(resource, policy=default_policy):
     """
     Downloads the MD5 digests associated with the files in a resource.
     These are saved with the downloaded files in the cache and used to
     check if the files have been updated on the server
     """
-    result = resource.xnat_session.get(resource.uri + '/files')
+    result = policy.call('list the files of {}'.format(resource.id),
+                         resource.xnat_session.get, resource.uri + '/files')
     if result.status_code != 200:
         raise XnatUtilsError(
             "Could not download metadata for resource {}. Files "
@@ -137,6 +156,174 @@ def get_digests(resource):
                 for r in result.json()['ResultSet']['Result'])
 
 
+def md5_digest(fname, chunk_size=DIGEST_CHUNK_SIZE):
+    """
+    Computes the MD5 digest of a file reading it in chunks, so that the
+    memory used does not depend on the size of the file
+    """
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class DigestReader(io.BufferedReader):
+    """
+    Binary file opened for reading that computes the MD5 digest of the data
+    while it is read. Passing it to an upload gives the digest of the
+    uploaded file without a second read pass.
+
+    Parameters
+    ----------
+    fname : str
+        Path of the file to open
+    """
+
+    def __init__(self, fname):
+        super(DigestReader, self).__init__(io.FileIO(fname, 'rb'))
+        self._reset()
+
+    def _reset(self):
+        self._md5 = hashlib.md5()
+        self._bytes_read = 0
+        self._sequential = True
+
+    def read(self, size=-1):
+        data = super(DigestReader, self).read(size)
+        self._md5.update(data)
+        self._bytes_read += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        position = super(DigestReader, self).seek(offset, whence)
+        if position == 0:
+            self._reset()
+        elif position != self._bytes_read:
+            self._sequential = False
+        return position
+
+    def hexdigest(self):
+        """
+        Returns the MD5 digest of the file, or None if the file has not been
+        read entirely from start to end
+        """
+        if (not self._sequential or
+                self._bytes_read != os.fstat(self.fileno()).st_size):
+            return None
+        return self._md5.hexdigest()
+
+
+class _ZipSink(io.RawIOBase):
+    "Non-seekable stream that holds the bytes written by ZipFile until popped"
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(filenames, digests=None, chunk_size=DIGEST_CHUNK_SIZE):
+    """
+    Generates a zip archive (without compression) of the given files on the
+    fly, chunk by chunk, so that it can be streamed in a single request
+    without creating a temporary archive on disk. The files are stored flat,
+    using their basename.
+
+    Parameters
+    ----------
+    filenames : list(str)
+        Files to add to the archive
+    digests : dict
+        If provided, the MD5 digest of each file, computed while it is
+        archived, is stored here using the file name as key
+    chunk_size : int
+        Size of the chunks read from each file
+    """
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zip_file:
+        for fname in filenames:
+            md5 = hashlib.md5()
+            info = zipfile.ZipInfo.from_file(fname, os.path.basename(fname))
+            with open(fname, 'rb') as src, zip_file.open(info, 'w') as dst:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    md5.update(chunk)
+                    dst.write(chunk)
+                    data = sink.pop()
+                    # an empty chunk would end a chunked HTTP request
+                    if data:
+                        yield data
+            if digests is not None:
+                digests[fname] = md5.hexdigest()
+    data = sink.pop()
+    if data:
+        yield data
+
+
+class _DigestWriter(object):
+    "Wraps a file opened for writing, computing the MD5 digest of the data written"
+
+    def __init__(self, f):
+        self._file = f
+        self._md5 = hashlib.md5()
+
+    def write(self, data):
+        self._md5.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+
+def download_file(write, target_path, policy=default_policy, digest=None):
+    """
+    Downloads a single file. The data is written to a temporary file in the
+    same directory, which is renamed to target_path once the download is
+    complete, so target_path is never left truncated.
+
+    Parameters
+    ----------
+    write : callable
+        Called as write(f), with f a file opened for binary writing, to
+        stream the content of the remote file into f (e.g. a call to the
+        download_stream method of a XnatPy session). It is called again for
+        each attempt
+    target_path : str
+        Path of the downloaded file
+    policy : basecore.database.retry.RetryPolicy
+        Policy used to repeat the download after transient errors
+    digest : str
+        If given, the MD5 digest of the data is computed while it is
+        downloaded and checked against it
+    """
+    tmp_path = target_path + '.part'
+
+    def download():
+        try:
+            with open(tmp_path, 'wb') as f:
+                writer = _DigestWriter(f)
+                write(writer)
+            if digest and writer.hexdigest() != digest:
+                raise XnatUtilsDigestCheckError(
+                    "Remote digest does not match local ({} vs {}) "
+                    "for {}".format(digest, writer.hexdigest(), target_path))
+            os.replace(tmp_path, target_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    policy.call('download ' + os.path.basename(target_path), download)
+
+
 def get_extension(resource_name):
     try:
         ext = resource_exts[resource_name]
@@ -147,7 +334,15 @@ def get_extension(resource_name):
 
 def _download_dataformat(resource_name, download_dir, session_label,
                          scan_label, exp, scan, subject_dirs, convert_to,
-                         converter, strip_name, suffix=False):
+                         converter, strip_name, suffix=False,
+                         convert_executor=None):
+    """
+    Downloads a resource of a scan to the download directory, converting it
+    to the format given by convert_to if required. If convert_executor (a
+    concurrent.futures executor) is provided, the conversion is submitted to
+    it and the Future of the conversion is returned, otherwise the conversion
+    is run before returning.
+    """
     # Get the target location for the downloaded scan
     if subject_dirs:
         parts = session_label.split('_')
@@ -180,7 +375,31 @@ def _download_dataformat(resource_name, download_dir, session_label,
     # Download the scan from XNAT
     print('Downloading {}: {}'.format(exp.label, scan_label))
     try:
-        scan.resources[resource_name].download_dir(tmp_dir)
+        resource = default_policy.call(
+            'find the {} resource of {}'.format(resource_name, scan_label),
+            lambda: scan.resources[resource_name])
+        if ((convert_to is None or convert_to.upper() == resource_name) and
+                resource_name not in ('DICOM', 'secondary')):
+            # The file objects of XnatPy do not carry the digests, so the
+            # listing is requested directly
+            xfiles = default_policy.call(
+                'list the files of ' + scan_label,
+                resource.xnat_session.get_json,
+                resource.uri + '/files')['ResultSet']['Result']
+            if len(xfiles) == 1:
+                # Single file resources are streamed directly to the target
+                # path, without the zip archive and the temporary directory,
+                # and checked against the digest stored by XNAT
+                if os.path.isdir(target_path):
+                    shutil.rmtree(target_path)
+                xfile = xfiles[0]
+                download_file(
+                    lambda f: resource.xnat_session.download_stream(
+                        xfile['URI'], f, chunk_size=DIGEST_CHUNK_SIZE),
+                    target_path, digest=xfile.get('digest'))
+                return True
+        default_policy.call('download ' + scan_label,
+                            resource.download_dir, tmp_dir)
     except KeyError:
         raise XnatUtilsMissingResourceException(
             resource_name, session_label, scan_label)
@@ -197,6 +416,18 @@ def _download_dataformat(resource_name, download_dir, session_label,
         except Exception:
             pass
         raise e
+    args = (resource_name, tmp_dir, target_dir, target_path, session_label,
+            scan_label, exp, scan, convert_to, converter, strip_name)
+    if (convert_executor is not None and convert_to is not None and
+            convert_to.upper() != resource_name):
+        # Convert in the background so that the next download can start
+        return convert_executor.submit(_convert_dataformat, *args)
+    return _convert_dataformat(*args)
+
+
+def _convert_dataformat(resource_name, tmp_dir, target_dir, target_path,
+                        session_label, scan_label, exp, scan, convert_to,
+                        converter, strip_name):
     # Extract the relevant data from the download dir and move to
     # target location
     src_path = os.path.join(tmp_dir, session_label, 'scans',
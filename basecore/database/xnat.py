@@ -1,20 +1,23 @@
 import os.path
-import hashlib
 from .base import (
     sanitize_re, illegal_scan_chars_re, get_resource_name,
     session_modality_re, connect, skip_resources,
     matching_sessions, matching_scans)
 from .exceptions import (
     XnatUtilsUsageError, XnatUtilsDigestCheckFailedError,
-    XnatUtilsDigestCheckError, XnatUtilsMissingResourceException)
-from .utils import get_digests, _download_dataformat
+    XnatUtilsDigestCheckError, XnatUtilsMissingResourceException,
+    XnatUtilsUploadError)
+from .utils import (
+    get_digests, _download_dataformat, md5_digest, DigestReader, iter_zip)
+from .retry import default_policy, get_policy
+from .metadata_cache import invalidate
 from past.builtins import basestring
 from collections import defaultdict
 from functools import reduce
 from operator import add
+from concurrent.futures import ThreadPoolExecutor, Future
 from basecore.utils.dicom import DicomInfo
-from xnat.exceptions import XNATResponseError
-import xnat
+from xnat.exceptions import XNATResponseError, XNATUploadError
 
 
 DICOM_TAGS = ['PatientSex', 'PatientBirthDate', 'SeriesDate']
@@ -58,6 +61,15 @@ def put(session, scan, *filenames, **kwargs):
         upload the dataset to. If not provided the format
         will be determined from the file extension (i.e.
         in most cases it won't be necessary to specify
+    num_threads : int
+        Number of files uploaded at the same time over the same session
+    retries : int
+        Number of attempts made to upload each file before giving up. Only
+        transient errors are retried, with exponential backoff (see
+        basecore.database.retry)
+    bundle : bool
+        Upload all the files in a single zip archive, streamed on the fly and
+        extracted by XNAT (useful for DICOM series with many slices)
     user : str
         The user to connect to the server with
     loglevel : str
@@ -84,6 +96,9 @@ def put(session, scan, *filenames, **kwargs):
     overwrite = kwargs.pop('overwrite', False)
     create_session = kwargs.pop('create_session', False,)
     resource_name = kwargs.pop('resource_name', None)
+    num_threads = kwargs.pop('num_threads', 1)
+    retries = kwargs.pop('retries', 3)
+    bundle = kwargs.pop('bundle', False)
     dicom_attributes = None
     # If a single directory is provided, upload all files in it that
     # don't start with '.'
@@ -125,95 +140,150 @@ def put(session, scan, *filenames, **kwargs):
         if resource_name == 'DICOM':
             info = DicomInfo(filenames[0])
             _, dicom_attributes = info.get_tag(DICOM_TAGS)
-#     with connect(**kwargs) as login:
-    login = xnat.connect('https://central.xnat.org', user="fsforazz", password="sono1genio!")
-    match = session_modality_re.match(session)
-    if match is None or match.group(1) == 'MR':
-        session_cls = login.classes.MrSessionData
-        scan_cls = login.classes.MrScanData
-    elif match is None or match.group(1) == 'CT' or match.group(1) == 'CTREF':
-        session_cls = login.classes.CtSessionData
-        scan_cls = login.classes.CtScanData
-    elif match is None or match.group(1) == 'RT':
-        session_cls = login.classes.RtSessionData
-        scan_cls = login.classes.RtImageScanData
-    else:
-        # Default to MRSession
-        session_cls = login.classes.MrSessionData
-        scan_cls = login.classes.MrScanData
-    try:
-        xsession = login.experiments[session]
-    except KeyError:
-        if create_session:
-            project_id = session.split('_')[0]
-            subject_id = '_'.join(session.split('_')[:2])
-            try:
-                xproject = login.projects[project_id]
-            except KeyError:
-                raise XnatUtilsUsageError(
-                    "Cannot create session '{}' as '{}' does not exist "
-                    "(or you don't have access to it)".format(session,
-                                                              project_id))
-            # Creates a corresponding subject and session if they don't
-            # exist
-            xsubject = login.classes.SubjectData(label=subject_id,
-                                                    parent=xproject)
-            if dicom_attributes is not None:
-                try:
-                    xsubject.demographics.gender = dicom_attributes['PatientSex'][0]
-                    xsubject.demographics.dob = dicom_attributes['PatientBirthDate'][0]
-                except:
-                    print('No valid DICOM attributes found. The subject instance will be '
-                          'created without those information.')
-                    pass
-            try:
-                xsession = session_cls(
-                    label=session, parent=xsubject)
-            except XNATResponseError:
-                print('Response Error, trying to continue..')
-            if dicom_attributes is not None and dicom_attributes['SeriesDate']:
-                xsession.date = dicom_attributes['SeriesDate'][0]
-            print("{} session successfully created."
-                  .format(xsession.label))
+    # Every request to XNAT, including the lookups of the lazy listings of
+    # XnatPy, is repeated after transient errors
+    policy = get_policy(retries)
+    with connect(**kwargs) as login:
+        match = session_modality_re.match(session)
+        if match is None or match.group(1) == 'MR':
+            session_cls = login.classes.MrSessionData
+            scan_cls = login.classes.MrScanData
+        elif match is None or match.group(1) == 'CT' or match.group(1) == 'CTREF':
+            session_cls = login.classes.CtSessionData
+            scan_cls = login.classes.CtScanData
+        elif match is None or match.group(1) == 'RT':
+            session_cls = login.classes.RtSessionData
+            scan_cls = login.classes.RtImageScanData
         else:
-            raise XnatUtilsUsageError(
-                "'{}' session does not exist, to automatically create it "
-                "please use '--create_session' option."
-                .format(session))
-    xdataset = scan_cls(id=scan, type=scan, parent=xsession)
-    if overwrite:
+            # Default to MRSession
+            session_cls = login.classes.MrSessionData
+            scan_cls = login.classes.MrScanData
         try:
-            xdataset.resources[resource_name].delete()
-            print("Deleted existing dataset at {}:{}".format(
-                session, scan))
+            xsession = policy.call('find session ' + session,
+                                   lambda: login.experiments[session])
         except KeyError:
-            pass
-    resource = xdataset.create_resource(resource_name)
-    for fname in filenames:
-        resource.upload(fname, os.path.basename(fname))
-        print("{} uploaded to {}:{}".format(
-            fname, session, scan))
-    print("Uploaded files, checking digests...")
-    # Check uploaded files checksums
-    remote_digests = get_digests(resource)
-    for fname in filenames:
-        remote_digest = remote_digests[
-            os.path.basename(fname).replace(' ', '%20')]
-        with open(fname, 'rb') as f:
+            if create_session:
+                project_id = session.split('_')[0]
+                subject_id = '_'.join(session.split('_')[:2])
+                try:
+                    xproject = policy.call('find project ' + project_id,
+                                           lambda: login.projects[project_id])
+                except KeyError:
+                    raise XnatUtilsUsageError(
+                        "Cannot create session '{}' as '{}' does not exist "
+                        "(or you don't have access to it)".format(session,
+                                                                  project_id))
+                # Creates a corresponding subject and session if they don't
+                # exist
+                xsubject = policy.call('create subject ' + subject_id,
+                                       login.classes.SubjectData,
+                                       label=subject_id, parent=xproject)
+                if dicom_attributes is not None:
+                    try:
+                        xsubject.demographics.gender = dicom_attributes['PatientSex'][0]
+                        xsubject.demographics.dob = dicom_attributes['PatientBirthDate'][0]
+                    except:
+                        print('No valid DICOM attributes found. The subject instance will be '
+                              'created without those information.')
+                        pass
+                try:
+                    xsession = policy.call('create session ' + session,
+                                           session_cls, label=session,
+                                           parent=xsubject)
+                except XNATResponseError:
+                    print('Response Error, trying to continue..')
+                if dicom_attributes is not None and dicom_attributes['SeriesDate']:
+                    xsession.date = dicom_attributes['SeriesDate'][0]
+                print("{} session successfully created."
+                      .format(xsession.label))
+            else:
+                raise XnatUtilsUsageError(
+                    "'{}' session does not exist, to automatically create it "
+                    "please use '--create_session' option."
+                    .format(session))
+        xdataset = policy.call('create scan ' + scan, scan_cls, id=scan,
+                               type=scan, parent=xsession)
+        if overwrite:
+            try:
+                policy.call('delete {}:{}'.format(scan, resource_name),
+                            lambda: xdataset.resources[resource_name].delete())
+                print("Deleted existing dataset at {}:{}".format(
+                    session, scan))
+            except KeyError:
+                pass
+        resource = policy.call('create resource ' + resource_name,
+                               xdataset.create_resource, resource_name)
+        project_uri = '/data/projects/{}'.format(session.split('_')[0])
+        invalidate(login, project_uri)
+
+        def attempt(name, send):
+            # A failed attempt may have left a partial upload behind, so the
+            # following ones overwrite it
+            attempts = []
+
+            def send_once():
+                attempts.append(name)
+                return send(len(attempts) > 1)
             try:
-                local_digest = hashlib.md5(f.read()).hexdigest()
-            except OSError:
-                raise XnatUtilsDigestCheckFailedError(
-                    "Could not check digest of '{}' "
-                    "(reference '{}'), possibly file too large"
-                    .format(fname, remote_digest))
-        if local_digest != remote_digest:
-            raise XnatUtilsDigestCheckError(
-                "Remote digest does not match local ({} vs {}) "
-                "for {}. Please upload your datasets again"
-                .format(remote_digest, local_digest, fname))
-        print("Successfully checked digest for {}".format(
-            fname, session, scan))
+                return policy.call('upload ' + name, send_once)
+            except (XNATResponseError, XNATUploadError, IOError) as e:
+                raise XnatUtilsUploadError(
+                    "Could not upload '{}' to {}:{} after {} attempts ({})"
+                    .format(name, session, scan, len(attempts), e))
+
+        def upload(fname):
+            def send(overwrite):
+                # The local digest is computed while the file is streamed to XNAT
+                with DigestReader(fname) as f:
+                    resource.upload(f, os.path.basename(fname),
+                                    overwrite=overwrite)
+                    return f.hexdigest()
+            digest = attempt(fname, send)
+            print("{} uploaded to {}:{}".format(
+                fname, session, scan))
+            return digest
+
+        if bundle:
+            # All the files are streamed in a single zip archive, which is
+            # extracted by XNAT into the resource
+            local_digests = {}
+            archive = '{}.zip'.format(scan)
+
+            def send(overwrite):
+                local_digests.clear()
+                resource.upload(iter_zip(filenames, local_digests), archive,
+                                overwrite=overwrite, extract=True)
+            attempt(archive, send)
+            print("{} files uploaded to {}:{} as {}".format(
+                len(filenames), session, scan, archive))
+        elif num_threads > 1 and len(filenames) > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                local_digests = dict(zip(filenames,
+                                         executor.map(upload, filenames)))
+        else:
+            local_digests = dict((fname, upload(fname)) for fname in filenames)
+        invalidate(login, project_uri)
+        print("Uploaded files, checking digests...")
+        # Check uploaded files checksums
+        remote_digests = get_digests(resource, policy=policy)
+        for fname in filenames:
+            remote_digest = remote_digests[
+                os.path.basename(fname).replace(' ', '%20')]
+            local_digest = local_digests[fname]
+            if local_digest is None:
+                try:
+                    local_digest = md5_digest(fname)
+                except OSError:
+                    raise XnatUtilsDigestCheckFailedError(
+                        "Could not check digest of '{}' "
+                        "(reference '{}')".format(fname, remote_digest))
+            if local_digest != remote_digest:
+                raise XnatUtilsDigestCheckError(
+                    "Remote digest does not match local ({} vs {}) "
+                    "for {}. Please upload your datasets again"
+                    .format(remote_digest, local_digest, fname))
+            print("Successfully checked digest for {}".format(
+                fname, session, scan))
 
 
 def get(session, download_dir, scans=None, resource_name=None,
@@ -314,6 +384,12 @@ def get(session, download_dir, scans=None, resource_name=None,
     match_scan_id : bool
         Whether to use the scan ID to match scans with if the scan type
         is None
+    num_threads : int
+        Number of scans downloaded at the same time over the same session
+    convert_threads : int
+        If greater than 0, the conversions requested with 'convert_to' run
+        in a separate pool of this many threads, overlapping with the
+        downloads of the following scans
     user : str
         The user to connect to the server with
     loglevel : str
@@ -338,63 +414,131 @@ def get(session, download_dir, scans=None, resource_name=None,
     # Convert scan string to list of scan strings if only one provided
     if isinstance(scans, basestring):
         scans = [scans]
+    num_threads = kwargs.pop('num_threads', 1)
+    convert_threads = kwargs.pop('convert_threads', 0)
     if skip_downloaded:
         skip = [d for d in os.listdir(download_dir)
                 if os.path.isdir(os.path.join(download_dir, d))]
     else:
         skip = []
     with connect(**kwargs) as login:
-        matched_sessions = matching_sessions(
-            login, session, with_scans=with_scans,
-            without_scans=without_scans, project_id=project_id,
-            skip=skip, before=before, after=after)
-        downloaded_scans = defaultdict(list)
+        # The listings of XnatPy are loaded lazily, so the requests are made
+        # (and repeated after transient errors) when they are first accessed
+        matched_sessions = default_policy.call(
+            'list the sessions', matching_sessions, login, session,
+            with_scans=with_scans, without_scans=without_scans,
+            project_id=project_id, skip=skip, before=before, after=after)
+        jobs = []
         for session in matched_sessions:
-            for scan in matching_scans(session, scans,
-                                       match_id=match_scan_id):
+            session_scans = default_policy.call(
+                'list the scans of ' + session.label, matching_scans, session,
+                scans, match_id=match_scan_id)
+            for scan in session_scans:
                 scan_label = scan.id
                 if scan.type is not None:
                     scan_label += '-' + sanitize_re.sub('_', scan.type)
-                downloaded = False
-                if resource_name is not None:
-                    try:
-                        downloaded = _download_dataformat(
-                            (resource_name.upper()
-                             if resource_name != 'secondary'
-                             else 'secondary'), download_dir, session.label,
-                            scan_label, session, scan, subject_dirs,
-                            convert_to, converter, strip_name)
-                    except XnatUtilsMissingResourceException:
-                        print(
-                            "Did not find '{}' resource for {}:{}, "
-                            "skipping".format(
-                                resource_name, session.label,
-                                scan_label))
-                        continue
+                jobs.append((session, scan, scan_label))
+        if convert_to is not None and convert_threads > 0:
+            # Conversions run in their own pool while the next scans are
+            # downloaded
+            convert_pool = ThreadPoolExecutor(max_workers=convert_threads)
+        else:
+            convert_pool = None
+
+        def download(job):
+            session, scan, scan_label = job
+            downloaded = False
+            if resource_name is not None:
+                try:
+                    downloaded = _download_dataformat(
+                        (resource_name.upper()
+                         if resource_name != 'secondary'
+                         else 'secondary'), download_dir, session.label,
+                        scan_label, session, scan, subject_dirs,
+                        convert_to, converter, strip_name,
+                        convert_executor=convert_pool)
+                except XnatUtilsMissingResourceException:
+                    print(
+                        "Did not find '{}' resource for {}:{}, "
+                        "skipping".format(
+                            resource_name, session.label,
+                            scan_label))
+                    return False
+            else:
+                resource_names = [
+                    r.label for r in default_policy.call(
+                        'list the resources of ' + scan_label,
+                        lambda: list(scan.resources.values()))
+                    if r.label not in skip_resources]
+                if not resource_names:
+                    print(
+                        "No valid scan formats for '{}-{}' in '{}' "
+                        "(found '{}')"
+                        .format(scan.id, scan.type, session,
+                                "', '".join(scan.resources)))
+                elif len(resource_names) > 1:
+                    downloaded = [
+                        _download_dataformat(
+                            scan_resource_name, download_dir,
+                            session.label, scan_label, session, scan,
+                            subject_dirs, convert_to, converter,
+                            strip_name, suffix=True,
+                            convert_executor=convert_pool)
+                        for scan_resource_name in resource_names]
                 else:
-                    resource_names = [
-                        r.label for r in scan.resources.values()
-                        if r.label not in skip_resources]
-                    if not resource_names:
-                        print(
-                            "No valid scan formats for '{}-{}' in '{}' "
-                            "(found '{}')"
-                            .format(scan.id, scan.type, session,
-                                    "', '".join(scan.resources)))
-                    elif len(resource_names) > 1:
-                        for scan_resource_name in resource_names:
-                            downloaded = _download_dataformat(
-                                scan_resource_name, download_dir,
-                                session.label, scan_label, session, scan,
-                                subject_dirs, convert_to, converter,
-                                strip_name, suffix=True)
-                    else:
-                        downloaded = _download_dataformat(
-                            resource_names[0], download_dir, session.label,
-                            scan_label, session, scan, subject_dirs,
-                            convert_to, converter, strip_name)
+                    downloaded = _download_dataformat(
+                        resource_names[0], download_dir, session.label,
+                        scan_label, session, scan, subject_dirs,
+                        convert_to, converter, strip_name,
+                        convert_executor=convert_pool)
+            return downloaded
+
+        def resolve(downloaded):
+            # Downloads run in the pool and conversions run in convert_pool
+            # return futures. For scans with several resources, the result
+            # of the last resource is used
+            while isinstance(downloaded, Future):
+                downloaded = downloaded.result()
+            if isinstance(downloaded, list):
+                return [resolve(d) for d in downloaded][-1]
+            return downloaded
+
+        downloaded_scans = defaultdict(list)
+        try:
+            if num_threads > 1 and len(jobs) > 1:
+                # The scans are downloaded concurrently, but the results are
+                # collected in the same order as the sequential download
+                with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                    results = [executor.submit(download, job) for job in jobs]
+            else:
+                # The results are wrapped in completed futures, so that the
+                # errors are handled as for the concurrent download
+                results = []
+                for job in jobs:
+                    result = Future()
+                    try:
+                        result.set_result(download(job))
+                    except Exception as e:
+                        result.set_exception(e)
+                    results.append(result)
+            # Errors are reported for each scan and the first one is raised
+            # once all the other scans have been downloaded and converted
+            errors = []
+            for (session, scan, scan_label), result in zip(jobs, results):
+                try:
+                    downloaded = resolve(result)
+                except Exception as e:
+                    print("Could not download {}:{} ({})".format(
+                        session.label, scan_label, e))
+                    errors.append(e)
+                    continue
                 if downloaded:
                     downloaded_scans[session.label].append(scan.type)
+            if errors:
+                raise errors[0]
+        finally:
+            if convert_pool is not None:
+                convert_pool.shutdown()
         if not downloaded_scans:
             print("No scans matched pattern(s) '{}' in specified "
                   "sessions ({})".format(
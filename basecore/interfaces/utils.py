@@ -1,16 +1,15 @@
 from nipype.interfaces.base import (
     BaseInterface, CommandLineInputSpec, TraitedSpec, Directory, File,
     traits, BaseInterfaceInputSpec, InputMultiPath)
-import pydicom
 import numpy as np
-from operator import itemgetter
-from pydicom.errors import InvalidDicomError
 from pathlib import Path
 import shutil
 import os
 import nibabel as nib
 import glob
-from basecore.utils.filemanip import split_filename
+import json
+from basecore.utils.filemanip import split_filename, stage_file
+from basecore.utils.dicom import dcm_info
 
 
 RT_NAMES = ['RTSTRUCT', 'RTDOSE', 'RTPLAN', 'RTCT']
@@ -23,6 +22,17 @@ class DicomCheckInputSpec(BaseInterfaceInputSpec):
 
     dicom_dir = Directory(exists=True, desc='Directory with the DICOM files to check')
     working_dir = Directory(exists=True, desc='Base directory to save the corrected DICOM files')
+    num_threads = traits.Int(1, usedefault=True,
+                             desc='Number of threads used to read the DICOM headers')
+    staging = traits.Enum('link', 'symlink', 'copy', usedefault=True,
+                          desc='How to put the selected DICOM files into the working '
+                          'directory: "link" (hardlink/reflink when possible, otherwise '
+                          'copy), "symlink" (hardlink/reflink when possible, otherwise '
+                          'symbolic link) or "copy"')
+    incremental = traits.Bool(True, usedefault=True,
+                              desc='If True, the output directory is not rebuilt when '
+                              'the DICOM files in dicom_dir did not change since the '
+                              'previous run')
 
 
 class DicomCheckOutputSpec(TraitedSpec):
@@ -50,31 +60,40 @@ class DicomCheck(BaseInterface):
 #         tp = dicom_dir.split('/')[-3]
 #         tp = ''
 #         scan_name = dicom_dir.split('/')[-1]
-        if scan_name in RT_NAMES:
-            if not os.path.isdir(os.path.join(wd, sub_name, tp, scan_name)):
-                os.makedirs(os.path.join(wd, sub_name, tp, scan_name))
+        outdir = os.path.join(wd, sub_name, tp, scan_name)
+        # the manifest is kept out of the conversion output, since
+        # ConversionCheck removes outdir once the scan is converted
+        manifest_file = os.path.join(wd, '.dicom_check', sub_name, tp,
+                                     '{}.json'.format(scan_name))
+        legacy_manifest = os.path.join(wd, sub_name, tp, '.{}_manifest.json'.format(scan_name))
+        if os.path.isfile(legacy_manifest):
+            os.remove(legacy_manifest)
+        source = self._source_manifest(dicom_dir)
+        staged = None
+        if self.inputs.incremental:
+            staged = self._load_manifest(manifest_file, source)
+        if staged is not None:
+            if self._is_staged(staged, outdir):
+                print('{} did not change since the last run, the staged files in {} '
+                      'will be reused.'.format(dicom_dir, outdir))
             else:
-                shutil.rmtree(os.path.join(wd, sub_name, tp, scan_name))
-                os.makedirs(os.path.join(wd, sub_name, tp, scan_name))
-            files = sorted(os.listdir(dicom_dir))
-            for item in files:
-                curr_item = os.path.join(dicom_dir, item)
-                if os.path.isdir(curr_item):
-                    shutil.copytree(curr_item, os.path.join(wd, sub_name, tp, scan_name, item))
-                else:
-                    shutil.copy2(curr_item, os.path.join(wd, sub_name, tp, scan_name))
+                print('{} did not change since the last run, the DICOM files selected '
+                      'then will be staged again in {}.'.format(dicom_dir, outdir))
+                self._stage(dicom_dir, outdir, staged)
         else:
-            dicoms, im_types, series_nums = self.dcm_info()
-            dicoms = self.dcm_check(dicoms, im_types, series_nums)
-            if dicoms:
-                if not os.path.isdir(os.path.join(wd, sub_name, tp, scan_name)):
-                    os.makedirs(os.path.join(wd, sub_name, tp, scan_name))
-                else:
-                    shutil.rmtree(os.path.join(wd, sub_name, tp, scan_name))
-                    os.makedirs(os.path.join(wd, sub_name, tp, scan_name))
-                for d in dicoms:
-                    shutil.copy2(d, os.path.join(wd, sub_name, tp, scan_name))
-        self.outdir = os.path.join(wd, sub_name, tp, scan_name)
+            if os.path.isfile(manifest_file):
+                os.remove(manifest_file)
+            if scan_name in RT_NAMES:
+                staged = {x: x for x in sorted(source)}
+            else:
+                dicoms, im_types, series_nums, headers = self.dcm_info()
+                dicoms = self.dcm_check(dicoms, im_types, series_nums, headers)
+                staged = {os.path.basename(d): os.path.relpath(d, dicom_dir)
+                          for d in dicoms}
+            if staged or scan_name in RT_NAMES:
+                self._stage(dicom_dir, outdir, staged)
+                self._write_manifest(manifest_file, source, staged)
+        self.outdir = outdir
         self.scan_name = scan_name
         self.base_dir = os.path.join(wd, sub_name, tp)
         return runtime
@@ -87,6 +106,55 @@ class DicomCheck(BaseInterface):
 
         return outputs
 
+    def _source_manifest(self, dicom_dir):
+        "Returns the size and modification time of all the files in dicom_dir"
+        manifest = {}
+        for root, _, files in os.walk(dicom_dir):
+            for f in files:
+                st = os.stat(os.path.join(root, f))
+                manifest[os.path.relpath(os.path.join(root, f), dicom_dir)] = [
+                    st.st_size, st.st_mtime_ns]
+        return manifest
+
+    def _load_manifest(self, manifest_file, source):
+        """Returns the files staged by a previous run, as a dictionary {path in
+        outdir: path in dicom_dir}, if that run used the same source files and
+        the same staging method. Otherwise it returns None.
+        """
+        if not os.path.isfile(manifest_file):
+            return None
+        try:
+            with open(manifest_file, 'r') as f:
+                manifest = json.load(f)
+        except ValueError:
+            return None
+        if manifest.get('source') != source or manifest.get('staging') != self.inputs.staging:
+            return None
+        return manifest.get('staged')
+
+    def _is_staged(self, staged, outdir):
+        "Checks whether outdir still has all the staged files"
+        return (os.path.isdir(outdir)
+                and all(os.path.lexists(os.path.join(outdir, x)) for x in staged))
+
+    def _stage(self, dicom_dir, outdir, staged):
+        "Rebuilds outdir with the files in staged ({path in outdir: path in dicom_dir})"
+        if os.path.isdir(outdir):
+            shutil.rmtree(outdir)
+        os.makedirs(outdir)
+        for dst, src in staged.items():
+            dst = os.path.join(outdir, dst)
+            if not os.path.isdir(os.path.dirname(dst)):
+                os.makedirs(os.path.dirname(dst))
+            stage_file(os.path.join(dicom_dir, src), dst, method=self.inputs.staging)
+
+    def _write_manifest(self, manifest_file, source, staged):
+        if not os.path.isdir(os.path.dirname(manifest_file)):
+            os.makedirs(os.path.dirname(manifest_file))
+        with open(manifest_file, 'w') as f:
+            json.dump({'source': source, 'staging': self.inputs.staging,
+                       'staged': staged}, f)
+
     def dcm_info(self):
         """Function to extract information from a list of DICOM files in one folder. It returns a list of
         unique image types and scan numbers found in the input list of DICOMS.
@@ -102,45 +170,14 @@ class DicomCheck(BaseInterface):
             list of unique image types extracted from the DICOMS
         series_nums : list
             list of unique series numbers extracted from the DICOMS
+        headers : dict
+            dictionary with the header record of each DICOM file
         """
-        dcm_folder = Path(self.inputs.dicom_dir)
-
-        dicoms = sorted(list(dcm_folder.glob('*.dcm')))
-        if not dicoms:
-            dicoms = sorted(list(dcm_folder.glob('*.IMA')))
-            if not dicoms:
-                raise Exception('No DICOM files found in {}'.format(dcm_folder))
-
-        ImageTypes = []
-        SeriesNums = []
-        toRemove = []
-        InstanceNums = []
-        for dcm in dicoms:
-            try:
-                header = pydicom.read_file(str(dcm))
-                ImageTypes.append(tuple(header.ImageType))
-                SeriesNums.append(header.SeriesNumber)
-                InstanceNums.append(header.InstanceNumber)
-            except AttributeError:
-                print ('{} seems to do not have the right DICOM fields and '
-                       'will be removed from the folder'.format(dcm))
-                toRemove.append(dcm)
-            except InvalidDicomError:
-                print ('{} seems to do not have a readable DICOM header and '
-                       'will be removed from the folder'.format(dcm))
-                toRemove.append(dcm)
-        # the following lines are to check whether or not there are 2 set of exactly the same DICOM files in the folder
-        if (len(InstanceNums) == 2*(len(set(InstanceNums)))) and len(set(SeriesNums)) == 1:
-            sortedInstanceNums = sorted(zip(dicoms, InstanceNums), key=itemgetter(1))
-            uniqueInstanceNums = [x[0] for x in sortedInstanceNums[:][0:-1:2]]
-            toRemove = toRemove+uniqueInstanceNums
-        if toRemove:
-            for f in toRemove:
-                dicoms.remove(f)
-
-        return dicoms, list(set(ImageTypes)), list(set(SeriesNums))
-
-    def dcm_check(self, dicoms, im_types, series_nums):
+        return dcm_info(Path(self.inputs.dicom_dir),
+                        num_threads=self.inputs.num_threads,
+                        return_headers=True)
+
+    def dcm_check(self, dicoms, im_types, series_nums, headers):
         """Function to check the DICOM files in one folder. It is based on the glioma test data.
         This function checks the type of the image (to exclude those that are localizer acquisitions)
         and the series number (if in one folder there are more than one scans then this function will
@@ -154,19 +191,21 @@ class DicomCheck(BaseInterface):
             list of all image types extracted from the DICOM headers
         series_nums : list
             list of all scan numbers extracted from the DICOM headers
+        headers : dict
+            header records of the DICOMS, as returned by dcm_info
         Returns
         -------
         dcms : list
             list of DICOMS files
         """
         if len(im_types) > 1:
-            im_type = list([x for x in im_types if not 'PROJECTION IMAGE' in x
-                            and 'LOCALIZER' not in x][0])
+            im_type = tuple([x for x in im_types if not 'PROJECTION IMAGE' in x
+                             and 'LOCALIZER' not in x][0])
 
-            dcms = [x for x in dicoms if pydicom.read_file(str(x)).ImageType==im_type]
+            dcms = [x for x in dicoms if headers[x]['ImageType']==im_type]
         elif len(series_nums) > 1:
             series_num = np.max(series_nums)
-            dcms = [x for x in dicoms if pydicom.read_file(str(x)).SeriesNumber==series_num]
+            dcms = [x for x in dicoms if headers[x]['SeriesNumber']==series_num]
         else:
             dcms = dicoms
 
@@ -1,8 +1,8 @@
 import os
 import shutil
 import glob
-import pydicom
-from basecore.utils.dicom import DicomInfo
+from basecore.utils.dicom import series_index
+from basecore.utils.filemanip import stage_file
 from pathlib import Path
 import pickle
 
@@ -11,7 +11,7 @@ ALLOWED_EXT = ['.xlsx', '.csv']
 ILLEGAL_CHARACTERS = ['/', '(', ')', '[', ']', '{', '}', ' ', '-']
 
     
-def dicom_check(raw_data, temp_dir):
+def dicom_check(raw_data, temp_dir, staging='link'):
     """Function to arrange the mouse lung data into a proper struture.
     In particular, this function will look into each raw_data folder searching for
     the data with H50s in the series description field in the DICOM header. Then,
@@ -21,6 +21,10 @@ def dicom_check(raw_data, temp_dir):
     ----------
     raw_data : str
         path to the raw data folder 
+    temp_dir : str
+        path to the folder where the H50s data will be saved
+    staging : str
+        how to put the DICOM files into temp_dir (see basecore.utils.filemanip.stage_file)
     Returns
     -------
     pth : str
@@ -42,18 +46,22 @@ def dicom_check(raw_data, temp_dir):
     if not os.path.isdir(temp_dir):
         os.mkdir(temp_dir)
     basename = raw_data.split('/')[-1]
-    sequence_numbers = list(set([str(pydicom.read_file(x).SeriesNumber) for x in dicoms]))
+    # SeriesNumber -> [(path, InstanceNumber, SeriesDescription, AcquisitionDate, SeriesTime)]
+    sequences = series_index(dicoms, ['InstanceNumber', 'SeriesDescription',
+                                      'AcquisitionDate', 'SeriesTime'])
     for character in ILLEGAL_CHARACTERS:
         basename = basename.replace(character, '_')
-    for n_seq in sequence_numbers:                     
-        dicom_vols = [x for x in dicoms if n_seq==str(pydicom.read_file(x).SeriesNumber)]
-        dcm_hd = pydicom.read_file(dicom_vols[0])
-        if len(dicom_vols) > 1 and '50s' in dcm_hd.SeriesDescription and not processed:
-            dcm = DicomInfo(dicom_vols)
-            _, tag = dcm.get_tag(['AcquisitionDate', 'SeriesTime'])
+    for n_seq, vols in sequences.items():
+        dicom_vols = [x[0] for x in vols]
+        description = vols[0][2]
+        if (len(dicom_vols) > 1 and description is not None and '50s' in description
+                and not processed):
+            # unique values of the tags, as DicomInfo.get_tag returns them
+            tag = {'AcquisitionDate': list(set(str(x[3]) for x in vols if x[3] is not None)),
+                   'SeriesTime': list(set(str(x[4]) for x in vols if x[4] is not None))}
             folder_name = temp_dir+'/{0}_date_{1}_time_{2}'.format(basename, tag['AcquisitionDate'][0],
                                                                    tag['SeriesTime'][0])
-            slices = [pydicom.read_file(x).InstanceNumber for x in dicom_vols]
+            slices = [x[1] for x in vols]
             if len(slices) != len(set(slices)):
                 print('Duplicate slices found in {} for H50s sequence. Please check. '
                       'This subject will be excluded from the analysis.'.format(raw_data))
@@ -65,7 +73,7 @@ def dicom_check(raw_data, temp_dir):
                 os.mkdir(folder_name)
             for x in dicom_vols:
                 try:
-                    shutil.copy2(x, folder_name)
+                    stage_file(x, folder_name, method=staging)
                 except:
                     continue
             filename = sorted(glob.glob(folder_name+'/*{}'.format(ext)))[0]
@@ -2,8 +2,121 @@ import pydicom
 import numpy as np
 from operator import itemgetter
 import collections
+import collections.abc
 from pydicom.errors import InvalidDicomError
+from concurrent.futures import ThreadPoolExecutor
 import os
+from basecore.utils.dicom_cache import get_header_cache
+
+
+def _normalise(value):
+    "Converts a DICOM element value into a plain python type (int, str or tuple)"
+    if value is None:
+        return None
+    if isinstance(value, (str, bytes)):
+        return str(value)
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, collections.abc.Iterable):
+        return tuple(_normalise(v) for v in value)
+    return str(value)
+
+
+def read_header(dcm, tags):
+    """Function to read the header of one DICOM file, stopping before the pixel data,
+    and to extract the values of a list of tags from it.
+    Parameters
+    ----------
+    dcm : str
+        path to an existing DICOM file
+    tags : list
+        list of DICOM keywords to extract from the header
+    Returns
+    -------
+    record : dict
+        dictionary with one entry per tag. Tags not present in the header are
+        set to None
+    """
+    header = pydicom.read_file(str(dcm), stop_before_pixels=True)
+
+    return {t: _normalise(getattr(header, t, None)) for t in tags}
+
+
+def scan_headers(dicoms, tags, num_threads=1):
+    """Function to read the headers of a list of DICOM files. If num_threads is
+    greater than 1, the headers are read by a pool of at most num_threads threads,
+    which hides the latency of network storage. The persistent header cache
+    (see basecore.utils.dicom_cache) is checked first and only the files that
+    changed, or the tags that were never requested, are read from disk.
+    Parameters
+    ----------
+    dicoms : list
+        list of DICOM files
+    tags : list
+        list of DICOM keywords to extract from each header
+    num_threads : int
+        maximum number of files read at the same time
+    Returns
+    -------
+    records : list
+        list of dictionaries (see read_header), in the same order as dicoms.
+        Files without a readable DICOM header are set to None
+    """
+    cache = get_header_cache()
+    cached = cache.lookup(dicoms) if cache is not None else {}
+
+    def _read(dcm):
+        record = cached.get(dcm, {})
+        missing = [t for t in tags if t not in record]
+        if missing:
+            try:
+                record = dict(record, **read_header(dcm, missing))
+            except InvalidDicomError:
+                return None
+        return record
+
+    if num_threads > 1 and len(dicoms) > 1:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            records = list(executor.map(_read, dicoms))
+    else:
+        records = [_read(dcm) for dcm in dicoms]
+    if cache is not None:
+        cache.update({dcm: r for dcm, r in zip(dicoms, records)
+                      if r is not None and r is not cached.get(dcm)})
+
+    return [{t: r[t] for t in tags} if r is not None else None for r in records]
+
+
+def series_index(dicoms, tags, num_threads=1):
+    """Function to group a list of DICOM files by SeriesNumber, reading each header
+    only once.
+    Parameters
+    ----------
+    dicoms : list
+        list of DICOM files
+    tags : list
+        list of DICOM keywords to extract from each header
+    num_threads : int
+        number of threads used to read the DICOM headers
+    Returns
+    -------
+    series : dict
+        dictionary with the SeriesNumber (as string) as key and, as value, a list
+        of tuples (path, value of tags[0], value of tags[1], ...) for each file
+        in that series. Files without a readable header or without SeriesNumber
+        are ignored
+    """
+    series = collections.OrderedDict()
+    headers = scan_headers(dicoms, ['SeriesNumber']+tags, num_threads=num_threads)
+    for dcm, header in zip(dicoms, headers):
+        if header is None or header['SeriesNumber'] is None:
+            print ('{} seems to do not have a readable DICOM header or a SeriesNumber '
+                   'and will be ignored'.format(dcm))
+            continue
+        series.setdefault(str(header['SeriesNumber']), []).append(
+            tuple([dcm]+[header[t] for t in tags]))
+
+    return series
 
 
 class DicomInfo(object):
@@ -22,6 +135,19 @@ class DicomInfo(object):
                 self.dcms = dcms
         else:
             self.dcms = [dicoms]
+        # tag -> list of values, one per file in self.dcms
+        self.index = {}
+
+    def index_tags(self, tags):
+        """Reads the headers of all the DICOM files only once, extracting all the
+        tags that are not already in the index.
+        """
+        missing = [t for t in tags if t not in self.index]
+        if not missing:
+            return
+        records = scan_headers(self.dcms, missing)
+        for t in missing:
+            self.index[t] = [r[t] if r is not None else None for r in records]
 
     def get_tag(self, tag):
         
@@ -29,19 +155,16 @@ class DicomInfo(object):
 
         if type(tag) is not list:
             tag = [tag]
+        self.index_tags(tag)
         for t in tag:
             values = []
-            for dcm in self.dcms:
-                header = pydicom.read_file(str(dcm))
-                try:
-                    val = header.data_element(t).value
-                    if isinstance(val, collections.Iterable) and type(val) is not str:
-                        val = tuple(val)
-                    else:
-                        val = str(val)
-                    values.append(val)
-                except (AttributeError, KeyError):
+            for dcm, val in zip(self.dcms, self.index[t]):
+                if val is None:
                     print ('{} seems to do not have the requested DICOM field ({})'.format(dcm, t))
+                elif type(val) is not tuple:
+                    values.append(str(val))
+                else:
+                    values.append(val)
 
             tags[t] = list(set(values))
         
@@ -57,13 +180,18 @@ class DicomInfo(object):
         
         return toRemove
         
-def dcm_info(dcm_folder):
+def dcm_info(dcm_folder, num_threads=1, return_headers=False):
     """Function to extract information from a list of DICOM files in one folder. It returns a list of
     unique image types and scan numbers found in the input list of DICOMS.
     Parameters
     ----------
     dcm_folder : str
         path to an existing folder with DICOM files
+    num_threads : int
+        number of threads used to read the DICOM headers
+    return_headers : bool
+        whether or not to return also the header record of each DICOM file, so
+        that dcm_check does not need to read the files again
     Returns
     -------
     dicoms : list
@@ -72,6 +200,9 @@ def dcm_info(dcm_folder):
         list of unique image types extracted from the DICOMS
     series_nums : list
         list of unique series numbers extracted from the DICOMS
+    headers : dict
+        (only if return_headers is True) dictionary with one header record
+        (see read_header) for each DICOM file in dicoms
     """
     if type(dcm_folder) is not list:
         dicoms = sorted(list(dcm_folder.glob('*.dcm')))
@@ -85,20 +216,23 @@ def dcm_info(dcm_folder):
     SeriesNums = []
     toRemove = []
     InstanceNums = []
-    for dcm in dicoms:
-        try:
-            header = pydicom.read_file(str(dcm))
-            ImageTypes.append(tuple(header.ImageType))
-            SeriesNums.append(header.SeriesNumber)
-            InstanceNums.append(header.InstanceNumber)
-        except AttributeError:
-            print ('{} seems to do not have the right DICOM fields and '
+    headers = scan_headers(dicoms, ['ImageType', 'SeriesNumber', 'InstanceNumber'],
+                           num_threads=num_threads)
+    records = dict(zip(dicoms, headers))
+    for dcm, header in zip(dicoms, headers):
+        if header is None:
+            print ('{} seems to do not have a readable DICOM header and '
                    'will be removed from the folder'.format(dcm))
             toRemove.append(dcm)
-        except InvalidDicomError:
-            print ('{} seems to do not have a readable DICOM header and '
+        elif None in header.values():
+            print ('{} seems to do not have the right DICOM fields and '
                    'will be removed from the folder'.format(dcm))
             toRemove.append(dcm)
+        else:
+            ImageTypes.append(header['ImageType'])
+            SeriesNums.append(header['SeriesNumber'])
+            InstanceNums.append(header['InstanceNumber'])
+    # the following lines are to check whether or not there are 2 set of exactly the same DICOM files in the folder
     if (len(InstanceNums) == 2*(len(set(InstanceNums)))) and len(set(SeriesNums)) == 1:
         sortedInstanceNums = sorted(zip(dicoms, InstanceNums), key=itemgetter(1))
         uniqueInstanceNums = [x[0] for x in sortedInstanceNums[:][0:-1:2]]
@@ -106,11 +240,14 @@ def dcm_info(dcm_folder):
     if toRemove:
         for f in toRemove:
             dicoms.remove(f)
-    
+
+    if return_headers:
+        return (dicoms, list(set(ImageTypes)), list(set(SeriesNums)),
+                {dcm: records[dcm] for dcm in dicoms})
     return dicoms, list(set(ImageTypes)), list(set(SeriesNums))
 
 
-def dcm_check(dicoms, im_types, series_nums):
+def dcm_check(dicoms, im_types, series_nums, headers=None):
     """Function to check the DICOM files in one folder. It is based on the glioma test data.
     This function checks the type of the image (to exclude those that are localizer acquisitions)
     and the series number (if in one folder there are more than one scans then this function will
@@ -124,19 +261,26 @@ def dcm_check(dicoms, im_types, series_nums):
         list of all image types extracted from the DICOM headers
     series_nums : list
         list of all scan numbers extracted from the DICOM headers
+    headers : dict
+        (optional) header records returned by dcm_info. If not provided, the
+        headers will be read again from the DICOMS
     Returns
     -------
     dcms : list
         list of DICOMS files
     """
+    if (len(im_types) > 1 or len(series_nums) > 1) and headers is None:
+        headers = dict(zip(dicoms, scan_headers(dicoms, ['ImageType', 'SeriesNumber'])))
     if len(im_types) > 1:
-        im_type = list([x for x in im_types if not
-                        'PROJECTION IMAGE' in x][0])
+        im_type = tuple([x for x in im_types if not
+                         'PROJECTION IMAGE' in x][0])
 
-        dcms = [x for x in dicoms if pydicom.read_file(str(x)).ImageType==im_type]
+        dcms = [x for x in dicoms if headers[x] is not None
+                and headers[x]['ImageType']==im_type]
     elif len(series_nums) > 1:
         series_num = np.max(series_nums)
-        dcms = [x for x in dicoms if pydicom.read_file(str(x)).SeriesNumber==series_num]
+        dcms = [x for x in dicoms if headers[x] is not None
+                and headers[x]['SeriesNumber']==series_num]
     else:
         dcms = dicoms
     
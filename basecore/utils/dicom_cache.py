@@ -0,0 +1,116 @@
+import os
+import json
+import sqlite3
+import threading
+from .sqlite_db import SQLiteDatabase
+
+
+# Path of the header cache. It can be changed with the BASECORE_DICOM_CACHE
+# environment variable; setting it to an empty string disables the cache.
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'basecore',
+                             'dicom_headers.sqlite')
+# maximum number of SQL variables in one query
+MAX_VARIABLES = 500
+
+
+def _decode(value):
+    "JSON stores tuples as lists, so they need to be converted back"
+    if isinstance(value, list):
+        return tuple(_decode(v) for v in value)
+    return value
+
+
+class DicomHeaderCache(object):
+    """Persistent cache of DICOM header records (see basecore.utils.dicom.read_header).
+    Records are stored in a SQLite database, keyed by the absolute path of the
+    DICOM file, and are considered valid only if the size and the modification
+    time of the file did not change since they were stored.
+
+    Parameters
+    ----------
+    path : str
+        path to the SQLite database. It will be created if it does not exist
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.disabled = False
+        self._db = SQLiteDatabase(path, ['CREATE TABLE IF NOT EXISTS headers (path TEXT '
+                                         'PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                                         'record TEXT)'])
+        self._lock = threading.Lock()
+
+    def _disable(self, error):
+        print('The DICOM header cache {0} cannot be used ({1}). The headers will '
+              'be read from the files.'.format(self.path, error))
+        self.disabled = True
+
+    def lookup(self, dicoms):
+        """Returns a dictionary with the cached record of each DICOM file in dicoms
+        whose size and modification time did not change since it was cached.
+        """
+        if self.disabled:
+            return {}
+        stats = {}
+        for dcm in dicoms:
+            try:
+                st = os.stat(str(dcm))
+            except OSError:
+                continue
+            stats[os.path.abspath(str(dcm))] = (dcm, st.st_size, st.st_mtime_ns)
+        paths = list(stats.keys())
+        records = {}
+        try:
+            with self._lock:
+                conn = self._db.connect()
+                for i in range(0, len(paths), MAX_VARIABLES):
+                    chunk = paths[i:i+MAX_VARIABLES]
+                    rows = conn.execute(
+                        'SELECT path, size, mtime, record FROM headers WHERE path IN ({})'
+                        .format(','.join('?'*len(chunk))), chunk).fetchall()
+                    for path, size, mtime, record in rows:
+                        dcm, cur_size, cur_mtime = stats[path]
+                        if size == cur_size and mtime == cur_mtime:
+                            records[dcm] = {k: _decode(v) for k, v in json.loads(record).items()}
+        except (sqlite3.Error, OSError) as e:
+            self._disable(e)
+            return {}
+
+        return records
+
+    def update(self, records):
+        """Stores the records (dictionary DICOM file -> record) in the cache,
+        replacing the entries of files that changed.
+        """
+        if self.disabled or not records:
+            return
+        rows = []
+        for dcm, record in records.items():
+            try:
+                st = os.stat(str(dcm))
+            except OSError:
+                continue
+            rows.append((os.path.abspath(str(dcm)), st.st_size, st.st_mtime_ns,
+                         json.dumps(record)))
+        try:
+            with self._lock:
+                conn = self._db.connect()
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?)', rows)
+        except (sqlite3.Error, OSError) as e:
+            self._disable(e)
+
+
+_caches = {}
+
+
+def get_header_cache():
+    """Returns the DICOM header cache of this process, or None if the cache was
+    disabled through the BASECORE_DICOM_CACHE environment variable.
+    """
+    path = os.environ.get('BASECORE_DICOM_CACHE', DEFAULT_CACHE)
+    if not path:
+        return None
+    if path not in _caches:
+        _caches[path] = DicomHeaderCache(path)
+    return _caches[path]
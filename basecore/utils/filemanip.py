@@ -1,9 +1,21 @@
 import os
+import errno
+import shutil
+import tempfile
 import pandas as pd
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 ALLOWED_EXT = ['.xlsx', '.csv']
 ILLEGAL_CHARACTERS = ['/', '(', ')', '[', ']', '{', '}', ' ', '-']
+STAGING_METHODS = ['link', 'symlink', 'copy']
+# ioctl request used to clone (reflink) a file on Linux (btrfs, xfs)
+FICLONE = 0x40049409
+# errors of os.link after which stage_file tries the next staging method
+LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP)
 
 
 def split_filename(fname):
@@ -82,3 +94,75 @@ def batch_processing(input_data, key_col1='subjects', key_col2='masks', root='')
 def mergedict(a, b):
     a.update(b)
     return a
+
+
+def _reflink(src, dst):
+    """Creates a copy-on-write clone of src. Raises OSError if it is not supported.
+    The clone is written to a temporary file that then replaces dst, so an
+    existing dst is never opened for writing."""
+    if fcntl is None:
+        raise OSError('reflink is not supported on this platform')
+    fd, tmp = tempfile.mkstemp(prefix='.'+os.path.basename(dst), suffix='.reflink',
+                               dir=os.path.dirname(os.path.abspath(dst)))
+    try:
+        with open(src, 'rb') as fsrc:
+            with os.fdopen(fd, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def stage_file(src, dst, method='link'):
+    """Function to put a file into a working directory avoiding, when possible, a full
+    copy of the data. It has the same interface of shutil.copy2, so it can be used as
+    copy_function in shutil.copytree.
+    Parameters
+    ----------
+    src : str
+        path to the file to stage
+    dst : str
+        destination file or directory
+    method : str
+        'link' to create a hardlink, or a reflink if hardlinks are not possible, and
+        to copy the file only if src and dst are on different filesystems.
+        'symlink' is the same as 'link' but it creates a symbolic link instead of
+        the copy. 'copy' always copies the file
+    Returns
+    -------
+    dst : str
+        path to the staged file
+    """
+    if method not in STAGING_METHODS:
+        raise Exception('Staging method {0} not recognised. Allowed methods are: {1}'
+                        .format(method, ', '.join(STAGING_METHODS)))
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        # as shutil.copy2 does, staging a file onto itself (e.g. onto the link
+        # created by a previous call) is an error. Any other existing dst is
+        # replaced, without writing into it since it may be a link to other data
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            raise shutil.SameFileError('{0} and {1} are the same file'.format(src, dst))
+        os.remove(dst)
+    if method != 'copy':
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError as e:
+            if e.errno not in LINK_ERRORS:
+                raise
+        try:
+            _reflink(src, dst)
+            return dst
+        except OSError:
+            pass
+        if method == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+            return dst
+    shutil.copy2(src, dst)
+
+    return dst
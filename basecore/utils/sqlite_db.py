@@ -0,0 +1,38 @@
+import os
+import sqlite3
+
+
+class SQLiteDatabase(object):
+    """SQLite database opened on first use and shared by the threads of a
+    process. A connection cannot be shared with a forked process (i.e.
+    nipype MultiProc), so a new one is opened when the process changes.
+    The callers are responsible for serialising the access to the
+    connection (e.g. with a threading.Lock).
+
+    Parameters
+    ----------
+    path : str
+        path to the database. It will be created, with its folder, if it
+        does not exist
+    schema : list(str)
+        SQL statements run every time a connection is opened (e.g. CREATE
+        TABLE IF NOT EXISTS ...)
+    """
+
+    def __init__(self, path, schema=()):
+        self.path = os.path.abspath(path)
+        self.schema = list(schema)
+        self._conn = None
+        self._pid = None
+
+    def connect(self):
+        "Returns the connection of the current process"
+        if self._conn is None or self._pid != os.getpid():
+            folder = os.path.dirname(self.path)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            for statement in self.schema:
+                self._conn.execute(statement)
+            self._pid = os.getpid()
+        return self._conn
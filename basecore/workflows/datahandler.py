@@ -310,10 +310,22 @@ def datasink_base(datasink, datasource, workflow, sessions, reference,
 
 
 def xnat_datasink(project_id, sub_id, result_dir, user, pwd,
-                  url='https://central.xnat.org', processed=True):
-    
+                  url='https://central.xnat.org', processed=True,
+                  num_threads=4, queue=None):
+    """
+    Uploads the results of one subject (one sub-folder per session in
+    result_dir/sub_id) to XNAT. If queue (a
+    basecore.database.upload_queue.UploadQueue) is given, the subject is only
+    added to the queue and uploaded in the background, otherwise the
+    function returns once all the scans are uploaded.
+    """
     sub_folder = os.path.join(result_dir, sub_id)
     sessions = [x for x in sorted(os.listdir(sub_folder))
                 if os.path.isdir(os.path.join(sub_folder, x))]
+    if queue is not None:
+        queue.add(project_id, sub_id, sub_folder, sessions, url, user,
+                  processed=processed)
+        queue.start(url, user, pwd)
+        return
     put(project_id, sub_id, sessions, sub_folder, url=url,
-        pwd=pwd, user=user, processed=processed)
+        pwd=pwd, user=user, processed=processed, num_threads=num_threads)
@@ -6,7 +6,8 @@ from basecore.workflows.datahandler import (
     gbm_datasource, registration_datasource, xnat_datasink)
 from basecore.workflows.bet import brain_extraction
 from basecore.workflows.registration import longitudinal_registration
-import time
+from basecore.database.uploader import spool_subject
+from basecore.database.upload_queue import UploadQueue
 
 
 if __name__ == "__main__":
@@ -69,8 +70,13 @@ if __name__ == "__main__":
     sub_list = [x for x in sub_list if x not in processed]
     print('Number of subjects without processed: {}'.format(len(sub_list)))
 
+    UPLOAD_QUEUE = None
+    if ARGS.xnat_sink:
+        # the subjects left in the queue by a previous run are uploaded first
+        UPLOAD_QUEUE = UploadQueue(os.path.join(ARGS.work_dir, 'xnat_upload_queue.sqlite'))
+        UPLOAD_QUEUE.start(ARGS.xnat_url, ARGS.xnat_user, ARGS.xnat_pwd)
+
     for sub_id in sub_list:
-        ready = False
         NIPYPE_CACHE = os.path.join(NIPYPE_CACHE_BASE, sub_id)
         if ARGS.run_bet:
             datasource, sessions, reference = gbm_datasource(sub_id, BASE_DIR)
@@ -94,15 +100,8 @@ if __name__ == "__main__":
                   .format(CORES))
             workflow.run('MultiProc', plugin_args={'n_procs': CORES})
 
-        while not ready:
-            if not os.path.isdir('/nfs/extra_hd/result2upload/ready'):
-                shutil.copytree(os.path.join(RESULT_DIR, 'results', sub_id),
-                                '/nfs/extra_hd/result2upload/{}'.format(sub_id))
-                os.mkdir('/nfs/extra_hd/result2upload/ready')
-                ready = True
-            else:
-                print('Old results are still in the folder, wait 1 minute...')
-                time.sleep(60)
+        spool_subject(os.path.join(RESULT_DIR, 'results', sub_id),
+                      '/nfs/extra_hd/result2upload', sub_id)
         if ARGS.xnat_sink:
             print('Uploading the results to XNAT with the following parameters:')
             print('Server: {}'.format(ARGS.xnat_url))
@@ -110,10 +109,18 @@ if __name__ == "__main__":
             print('User ID: {}'.format(ARGS.xnat_user))
 
             xnat_datasink(ARGS.xnat_pid, sub_id, os.path.join(RESULT_DIR, 'results'),
-                          ARGS.xnat_user, ARGS.xnat_pwd, url=ARGS.xnat_url, processed=True)
+                          ARGS.xnat_user, ARGS.xnat_pwd, url=ARGS.xnat_url, processed=True,
+                          queue=UPLOAD_QUEUE)
 
-            print('Uploading successfully completed!')
+            print('Subject {} added to the upload queue.'.format(sub_id))
         if CLEAN_CACHE:
             shutil.rmtree(NIPYPE_CACHE)
 
+    if ARGS.xnat_sink:
+        print('Waiting for the uploads to XNAT to finish...')
+        UPLOAD_QUEUE.join()
+        for project, subject, error in UPLOAD_QUEUE.failed():
+            print('Could not upload subject {0} ({1})'.format(subject, error))
+        UPLOAD_QUEUE.stop()
+
     print('Done!')
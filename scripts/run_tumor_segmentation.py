@@ -9,6 +9,7 @@ from basecore.workflows.datahandler import (
     xnat_datasink)
 from basecore.database.pyxnat import get
 from basecore.database.base import get_subject_list
+from basecore.database.upload_queue import UploadQueue
 
 
 if __name__ == "__main__":
@@ -76,6 +77,12 @@ if __name__ == "__main__":
                                   'those results were pushed to XNAT.')
     
 
+    UPLOAD_QUEUE = None
+    if ARGS.xnat_sink:
+        # the subjects left in the queue by a previous run are uploaded first
+        UPLOAD_QUEUE = UploadQueue(os.path.join(ARGS.work_dir, 'xnat_upload_queue.sqlite'))
+        UPLOAD_QUEUE.start(ARGS.xnat_url, ARGS.xnat_user, ARGS.xnat_pwd)
+
     for sub_id in sub_list:
         print('Processing subject {}'.format(sub_id))
         NIPYPE_CACHE = os.path.join(NIPYPE_CACHE_BASE, sub_id)
@@ -115,10 +122,18 @@ if __name__ == "__main__":
             print('User ID: {}'.format(ARGS.xnat_user))
 
             xnat_datasink(ARGS.xnat_pid, sub_id, os.path.join(RESULT_DIR, 'results'),
-                          ARGS.xnat_user, ARGS.xnat_pwd, url=ARGS.xnat_url, processed=True)
+                          ARGS.xnat_user, ARGS.xnat_pwd, url=ARGS.xnat_url, processed=True,
+                          queue=UPLOAD_QUEUE)
 
-            print('Uploading successfully completed!')
+            print('Subject {} added to the upload queue.'.format(sub_id))
         if CLEAN_CACHE:
             shutil.rmtree(NIPYPE_CACHE)
 
+    if ARGS.xnat_sink:
+        print('Waiting for the uploads to XNAT to finish...')
+        UPLOAD_QUEUE.join()
+        for project, subject, error in UPLOAD_QUEUE.failed():
+            print('Could not upload subject {0} ({1})'.format(subject, error))
+        UPLOAD_QUEUE.stop()
+
     print('Done!')
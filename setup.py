@@ -4,7 +4,7 @@ setup(name='basecore',
       version='1.0',
       description='Repository with several utilities',
       url='https://github.com/sforazz/basecore',
-      python_requires='>=3.5',
+      python_requires='>=3.6',
       author='Francesco Sforazzini',
       author_email='f.sforazzini@dkfz.de',
       license='Apache 2.0',
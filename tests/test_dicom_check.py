@@ -0,0 +1,60 @@
+import os
+import numpy as np
+import nibabel as nib
+from basecore.interfaces.utils import DicomCheck, ConversionCheck
+
+
+def _make_source(tmpdir):
+    dicom_dir = tmpdir.mkdir('data').mkdir('sub01').mkdir('tp1').mkdir('T1')
+    for i in range(3):
+        dicom_dir.join('{}.dcm'.format(i)).write('dicom {}'.format(i))
+    return str(dicom_dir)
+
+
+def _fake_dcm_info(calls):
+    def dcm_info(self):
+        calls.append(self.inputs.dicom_dir)
+        dicoms = sorted(os.path.join(self.inputs.dicom_dir, x)
+                        for x in os.listdir(self.inputs.dicom_dir))
+        return dicoms, [('ORIGINAL', 'PRIMARY')], [1], {}
+    return dcm_info
+
+
+def _dicom_check(dicom_dir, wd):
+    check = DicomCheck(dicom_dir=dicom_dir, working_dir=wd)
+    return check.run().outputs
+
+
+def test_unchanged_scan_is_not_scanned_again(tmpdir, monkeypatch):
+    calls = []
+    monkeypatch.setattr(DicomCheck, 'dcm_info', _fake_dcm_info(calls))
+    dicom_dir = _make_source(tmpdir)
+    wd = str(tmpdir.mkdir('wd'))
+
+    outputs = _dicom_check(dicom_dir, wd)
+    assert sorted(os.listdir(outputs.outdir)) == ['0.dcm', '1.dcm', '2.dcm']
+
+    # dcm2niix writes into base_dir, then ConversionCheck removes the staged folder
+    converted = os.path.join(outputs.base_dir, 'T1.nii.gz')
+    nib.save(nib.Nifti1Image(np.zeros((4, 4, 4), dtype=np.int16), np.eye(4)), converted)
+    ConversionCheck(in_file=[converted], file_name='T1').run()
+    assert not os.path.isdir(outputs.outdir)
+
+    outputs = _dicom_check(dicom_dir, wd)
+    assert len(calls) == 1
+    assert sorted(os.listdir(outputs.outdir)) == ['0.dcm', '1.dcm', '2.dcm']
+    assert not [x for x in os.listdir(outputs.base_dir) if x.endswith('.json')]
+
+
+def test_changed_scan_is_scanned_again(tmpdir, monkeypatch):
+    calls = []
+    monkeypatch.setattr(DicomCheck, 'dcm_info', _fake_dcm_info(calls))
+    dicom_dir = _make_source(tmpdir)
+    wd = str(tmpdir.mkdir('wd'))
+
+    _dicom_check(dicom_dir, wd)
+    with open(os.path.join(dicom_dir, '3.dcm'), 'w') as f:
+        f.write('dicom 3')
+    outputs = _dicom_check(dicom_dir, wd)
+    assert len(calls) == 2
+    assert sorted(os.listdir(outputs.outdir)) == ['0.dcm', '1.dcm', '2.dcm', '3.dcm']
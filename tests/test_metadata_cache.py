@@ -0,0 +1,44 @@
+from basecore.database import metadata_cache
+from basecore.database.metadata_cache import MetadataCache
+
+
+class _XnatPySession(object):
+    _original_uri = 'https://xnat.example.org'
+    _logged_in_user = 'user'
+
+
+class _PyxnatInterface(object):
+    _server = 'https://xnat.example.org/'
+    _user = 'user'
+
+
+def test_xnatpy_and_pyxnat_share_the_listings():
+    cache = MetadataCache()
+    cache.set(_PyxnatInterface(), '/data/projects/P/subjects', None, [{'ID': 'S1'}])
+    assert cache.get(_XnatPySession(), '/data/projects/P/subjects') == [{'ID': 'S1'}]
+    cache.invalidate(_XnatPySession(), '/data/projects/P/subjects/S1')
+    assert cache.get(_PyxnatInterface(), '/data/projects/P/subjects') is None
+
+
+def test_expired_listings_are_dropped(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(metadata_cache.time, 'time', lambda: now[0])
+    cache = MetadataCache(ttl=10)
+    session = _XnatPySession()
+    cache.set(session, '/data/projects/P/subjects', None, [])
+    now[0] += 11
+    assert cache.get(session, '/data/projects/P/subjects') is None
+    assert not cache._listings
+
+
+def test_the_listings_in_memory_are_bounded(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(metadata_cache.time, 'time', lambda: now[0])
+    cache = MetadataCache(ttl=10, max_listings=3)
+    session = _XnatPySession()
+    for i in range(5):
+        cache.set(session, '/data/projects/P{}/subjects'.format(i), None, [i])
+        now[0] += 1
+    assert len(cache._listings) == 3
+    assert cache.get(session, '/data/projects/P0/subjects') is None
+    assert cache.get(session, '/data/projects/P4/subjects') == [4]
@@ -0,0 +1,66 @@
+import threading
+import pytest
+
+pytest.importorskip('xnat')
+pytest.importorskip('pyxnat')
+
+from requests import Response
+from basecore.database.pool import SessionPool, session_pool, check_response
+
+
+def test_login_does_not_block_other_sessions():
+    pool = SessionPool()
+    logging_in = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def slow_login():
+        calls.append('slow')
+        logging_in.set()
+        release.wait(5)
+        return 'slow session'
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(
+        pool.get('pyxnat', 'https://a', 'user', slow_login)))
+    second = threading.Thread(target=lambda: results.append(
+        pool.get('pyxnat', 'https://a', 'user', slow_login)))
+    first.start()
+    assert logging_in.wait(5)
+    second.start()
+    # another server can be used while the first login is still running
+    assert pool.get('pyxnat', 'https://b', 'user', lambda: 'other') == 'other'
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert results == ['slow session', 'slow session']
+    assert calls == ['slow']
+
+
+def test_failed_login_lets_the_next_caller_try_again():
+    pool = SessionPool()
+
+    def failing_login():
+        raise ValueError('login failed')
+
+    with pytest.raises(ValueError):
+        pool.get('pyxnat', 'https://a', 'user', failing_login)
+    assert pool.get('pyxnat', 'https://a', 'user', lambda: 'session') == 'session'
+
+
+def _response(status):
+    response = Response()
+    response.status_code = status
+    response.url = 'https://a/data/projects'
+    return response
+
+
+def test_rejected_login_discards_the_session():
+    session = object()
+    session_pool.add('pyxnat', 'https://expired', 'user', session)
+    with pytest.raises(Exception):
+        check_response(session, _response(503))
+    assert session_pool.find('pyxnat', 'https://expired', 'user') is session
+    with pytest.raises(Exception):
+        check_response(session, _response(401))
+    assert session_pool.find('pyxnat', 'https://expired', 'user') is None
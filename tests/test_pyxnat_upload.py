@@ -0,0 +1,48 @@
+import io
+import zipfile
+import pytest
+
+pytest.importorskip('xnat')
+pytest.importorskip('pyxnat')
+
+from basecore.database import pyxnat as pyxnat_upload
+
+
+class _Response(object):
+
+    def raise_for_status(self):
+        pass
+
+
+class _Interface(object):
+
+    _server = 'https://xnat.example.org'
+    _user = 'user'
+
+    def __init__(self):
+        self.requests = []
+
+    def put(self, uri, **kwargs):
+        kwargs['data'] = b''.join(kwargs['data'])
+        self.requests.append((uri, kwargs))
+        return _Response()
+
+
+def test_put_zip_sends_the_archive_in_the_body(tmpdir, monkeypatch):
+    monkeypatch.setattr(pyxnat_upload, 'check_digests', lambda *args: None)
+    filenames = []
+    for i in range(2):
+        fname = tmpdir.join('{}.dcm'.format(i))
+        fname.write('dicom {}'.format(i))
+        filenames.append(str(fname))
+    interface = _Interface()
+    resource_uri = '/data/projects/P1/experiments/E1/scans/T1/resources/DICOM'
+
+    pyxnat_upload.put_zip(interface, resource_uri, filenames, 'T1.zip')
+
+    [(uri, kwargs)] = interface.requests
+    assert uri == resource_uri + '/files/T1.zip'
+    assert kwargs['params'] == {'extract': 'true', 'inbody': 'true', 'overwrite': 'true'}
+    assert kwargs['headers'] == {'Content-Type': 'application/zip'}
+    with zipfile.ZipFile(io.BytesIO(kwargs['data'])) as archive:
+        assert sorted(archive.namelist()) == ['0.dcm', '1.dcm']
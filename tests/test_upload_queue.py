@@ -0,0 +1,67 @@
+import threading
+import pytest
+
+pytest.importorskip('xnat')
+pytest.importorskip('pyxnat')
+
+from basecore.database import upload_queue
+from basecore.database.upload_queue import UploadQueue, DONE, SUPERSEDED
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    "Replaces the XNAT calls of the queue, recording the scans uploaded"
+    uploaded = []
+    planned = []
+    started = threading.Event()
+    release = threading.Event()
+    release.set()
+
+    def plan_upload(interface, project, subject, sessions, sub_folder, processed):
+        planned.append(sessions)
+        return [[session, scan] for session in sessions for scan in ('T1', 'T2')]
+
+    def upload_scan(interface, job):
+        started.set()
+        release.wait(5)
+        uploaded.append(tuple(job))
+
+    monkeypatch.setattr(upload_queue, 'get_interface', lambda **kwargs: None)
+    monkeypatch.setattr(upload_queue, 'plan_upload', plan_upload)
+    monkeypatch.setattr(upload_queue, 'upload_scan', upload_scan)
+    return uploaded, planned, started, release
+
+
+def test_subject_added_again_supersedes_the_running_upload(tmpdir, uploads):
+    uploaded, planned, started, release = uploads
+    release.clear()
+    queue = UploadQueue(str(tmpdir.join('queue.sqlite')), num_threads=1,
+                        poll_interval=0.1)
+    old_id = queue.add('P', 'sub1', str(tmpdir), ['MR1'], 'https://xnat', 'user')
+    queue.start('https://xnat', 'user', 'pwd')
+    try:
+        assert started.wait(5)
+        new_id = queue.add('P', 'sub1', str(tmpdir), ['MR1', 'MR2'],
+                           'https://xnat', 'user')
+        release.set()
+        assert queue.join(10)
+    finally:
+        queue.stop()
+
+    # the scan being uploaded is completed, the other one is left to the new entry
+    assert uploaded == [('MR1', 'T1'), ('MR1', 'T1'), ('MR1', 'T2'),
+                        ('MR2', 'T1'), ('MR2', 'T2')]
+    assert queue.status() == {SUPERSEDED: 1, DONE: 1}
+    states = dict(queue._execute('SELECT id, state FROM subjects'))
+    assert states == {old_id: SUPERSEDED, new_id: DONE}
+    assert queue._execute('SELECT position, state FROM scans WHERE subject_id=? '
+                          'ORDER BY position', (old_id,)) == [(0, DONE), (1, 'pending')]
+
+
+def test_join_returns_when_the_workers_die(tmpdir, uploads, monkeypatch):
+    queue = UploadQueue(str(tmpdir.join('queue.sqlite')), poll_interval=0.1)
+    # the workers exit without ever going idle
+    monkeypatch.setattr(queue, 'run', lambda: None)
+    queue.add('P', 'sub1', str(tmpdir), ['MR1'], 'https://xnat', 'user')
+    queue.start('https://xnat', 'user', 'pwd')
+    assert queue.join(10) is False
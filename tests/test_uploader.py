@@ -0,0 +1,52 @@
+import os
+import time
+import threading
+from basecore.database.uploader import UploadService, spool_subject, READY_MARKER
+
+
+def _results(tmpdir, name):
+    src = tmpdir.mkdir(name)
+    src.mkdir('MR1').join('T1.nii.gz').write(name)
+    return str(src)
+
+
+def test_pending_skips_the_ready_marker(tmpdir):
+    spool_dir = tmpdir.mkdir('spool')
+    # previous layout: spool_dir/sub_id and the ready marker next to it
+    spool_dir.mkdir('sub01').mkdir('MR1')
+    spool_dir.mkdir(READY_MARKER)
+    job = spool_subject(_results(tmpdir, 'results'), str(spool_dir), 'sub02')
+
+    service = UploadService(str(spool_dir), upload=None)
+    assert service.pending() == sorted(['sub01', job])
+    assert os.path.isdir(str(spool_dir.join(READY_MARKER)))
+
+
+def test_waiting_job_starts_when_the_running_upload_finishes(tmpdir):
+    spool_dir = str(tmpdir.mkdir('spool'))
+    uploading = threading.Event()
+    release = threading.Event()
+    uploaded = []
+
+    def upload(sub_id, results_dir):
+        with open(os.path.join(results_dir, sub_id, 'MR1', 'T1.nii.gz')) as f:
+            uploaded.append(f.read())
+        uploading.set()
+        release.wait(5)
+
+    service = UploadService(spool_dir, upload, poll_interval=30, use_inotify=False)
+    spool_subject(_results(tmpdir, 'first'), spool_dir, 'sub01')
+    thread = service.start()
+    try:
+        assert uploading.wait(5)
+        spool_subject(_results(tmpdir, 'second'), spool_dir, 'sub01')
+        release.set()
+        deadline = time.time() + 5
+        while len(uploaded) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        assert uploaded == ['first', 'second']
+    finally:
+        release.set()
+        service.stop()
+        thread.join(5)
+    assert not thread.is_alive()